@@ -9,7 +9,9 @@ except: pass
 #===============================================================================
 # Import
 #===============================================================================
-from common import mergeArray, runBackground, asleep, BaseControl, AuthInfo, EpException
+import json
+import asyncio
+from common import runBackground, asleep, getTokenClaims, getNewsAndDelsArray, getRandomString, encodeBase64, decodeBase64, BaseControl, AuthInfo, CRUD, EpException
 from driver.keyclock import KeyCloak
 from driver.redis import RedisAccount
 from driver.minio import Minio
@@ -28,11 +30,17 @@ class Control(BaseControl):
         self.accountDefaultAcl = self.config[f'{self.module}:acl']
         self.accountRestrict = self.config[f'{self.module}:restrict']
         self.accountRestrictGroups = [code.strip() for code in self.accountRestrict['restrict_groups'].split(',')]
+        kcConf = self.config['keycloak']
+        self.keycloakConcurrency = int(kcConf['concurrency']) if 'concurrency' in kcConf and kcConf['concurrency'] else 8
+        self.keycloakPageSize = int(kcConf['page_size']) if 'page_size' in kcConf and kcConf['page_size'] else 500
+        self.jobExpire = int(kcConf['job_expire']) if 'job_expire' in kcConf and kcConf['job_expire'] else 3600
+        self.countExpire = int(kcConf['count_expire']) if 'count_expire' in kcConf and kcConf['count_expire'] else 60
 
     async def startup(self):
         await self.redis.initialize()
         await self.keycloak.initialize(
-            defaultAcl=self.accountDefaultAcl
+            defaultAcl=self.accountDefaultAcl,
+            directory=self.redis
         )
         await self.minio.initialize(
             keycloak={
@@ -42,6 +50,7 @@ class Control(BaseControl):
             }
         )
         self.userGroupId = (await self.keycloak.readGroupByName(self.tenant, self.userGroupName))['id']
+        for role in await self.keycloak.searchRoles(self.tenant, brief=False): await self.syncRoleAcl(role)
         await runBackground(self.__syncSystemToken__())
 
     async def shutdown(self):
@@ -59,13 +68,139 @@ class Control(BaseControl):
                 else: tokens = await self.keycloak.login(self.tenant, self.tenant, self.systemAccessKey, self.systemSecretKey)
                 await self.redis.setSystemToken(tokens['access_token'])
             except Exception as e: EpException(500, e)
-            await asleep(600)
+            await asleep(max(10, min(600, int(tokens['expires_in']) - 60)) if tokens and 'expires_in' in tokens else 600)
+
+    async def syncRoleAcl(self, role:dict):
+        acl = {sref: crud[0] for sref, crud in role['attributes'].items()} if 'attributes' in role and role['attributes'] else {}
+        await self.redis.setRoleAcl(role['name'], acl)
+        return acl
+
+    async def getRoleAcls(self, roleNames:list[str]):
+        roleAcls = await self.redis.getRoleAcls(*roleNames) if roleNames else {}
+        missRoleNames = [roleName for roleName in roleNames if roleName not in roleAcls]
+        if missRoleNames:
+            semaphore = asyncio.Semaphore(self.keycloakConcurrency)
+            async def readRoleAcl(roleName):
+                async with semaphore: return await self.syncRoleAcl(await self.keycloak.readRoleByName(self.tenant, roleName))
+            for roleName, acl in zip(missRoleNames, await asyncio.gather(*[readRoleAcl(roleName) for roleName in missRoleNames])): roleAcls[roleName] = acl
+        return roleAcls
+
+    def toUser(self, user:dict):
+        user['sref'] = 'User'
+        user['uref'] = f'{self.uriver}/users/{user["id"]}'
+        return user
+
+    def toGroup(self, group:dict):
+        groupId = group['id']
+        return {
+            'id': groupId,
+            'parentId': group['parentId'] if 'parentId' in group else '',
+            'sref': 'Group',
+            'uref': f'{self.uriver}/groups/{groupId}',
+            'code': group['realmRoles'][0] if 'realmRoles' in group and group['realmRoles'] else '',
+            'name': group['name'],
+            'path': group['path'],
+            'subGroupCount': group['subGroupCount'] if 'subGroupCount' in group else 0
+        }
+
+    def encodeCursor(self, skip:int): return encodeBase64(str(skip))
+
+    def decodeCursor(self, cursor:str):
+        try: return int(decodeBase64(cursor))
+        except: raise EpException(400, 'Bad Request')
+
+    async def countUsers(self, search:str | None=None):
+        count = await self.redis.getCount('user', search)
+        if count is None:
+            count = await self.keycloak.countUsers(self.tenant, search)
+            await self.redis.setCount('user', search, count, self.countExpire)
+        return count
+
+    async def countGroups(self, search:str | None=None):
+        count = await self.redis.getCount('group', search)
+        if count is None:
+            count = await self.keycloak.countGroups(self.tenant, search)
+            await self.redis.setCount('group', search, count, self.countExpire)
+        return count
+
+    async def exportUsers(self, search:str | None=None):
+        first = 0
+        while True:
+            users = await self.keycloak.searchUsers(self.tenant, search, first, self.keycloakPageSize)
+            for user in users: yield json.dumps(self.toUser(user), separators=(',', ':')) + '\n'
+            if len(users) < self.keycloakPageSize: break
+            first += self.keycloakPageSize
+
+    async def exportGroups(self, search:str | None=None):
+        first = 0
+        while True:
+            groups = await self.keycloak.searchGroups(self.tenant, search, first, self.keycloakPageSize)
+            for group in groups: yield json.dumps(self.toGroup(group), separators=(',', ':')) + '\n'
+            if len(groups) < self.keycloakPageSize: break
+            first += self.keycloakPageSize
+
+    async def searchGroupMemberIds(self, groupId:str):
+        memberIds = []
+        first = 0
+        while True:
+            members = await self.keycloak.searchUsersByGroupId(self.tenant, groupId, first, self.keycloakPageSize, brief=True)
+            memberIds += [member['id'] for member in members]
+            if len(members) < self.keycloakPageSize: return memberIds
+            first += self.keycloakPageSize
+
+    async def updateGroupMembers(self, groupId:str, userIds:list[str], job:dict | None=None):
+        news, dels = getNewsAndDelsArray(userIds, await self.searchGroupMemberIds(groupId))
+        results = job['results'] if job is not None else []
+        if job is not None: job['total'] = len(news) + len(dels)
+        semaphore = asyncio.Semaphore(self.keycloakConcurrency)
+
+        async def updateGroupMember(userId, action):
+            async with semaphore:
+                try:
+                    if action == 'add': await self.keycloak.setUserToGroup(self.tenant, userId, groupId)
+                    else: await self.keycloak.unsetUserFromGroup(self.tenant, userId, groupId)
+                    result = {'id': userId, 'action': action, 'status': 'ok'}
+                except Exception as e: result = {'id': userId, 'action': action, 'status': 'error', 'message': str(e)}
+            results.append(result)
+            if job is not None:
+                job['done'] += 1
+                if result['status'] != 'ok': job['failed'] += 1
+
+        await asyncio.gather(*[updateGroupMember(userId, 'add') for userId in news], *[updateGroupMember(userId, 'remove') for userId in dels])
+        return results
+
+    async def startGroupMembersJob(self, groupId:str, userIds:list[str]):
+        job = {'id': getRandomString(32), 'groupId': groupId, 'status': 'running', 'total': 0, 'done': 0, 'failed': 0, 'results': []}
+        await self.redis.writeJob(job['id'], job, self.jobExpire)
+
+        async def runJob():
+            task = asyncio.create_task(self.updateGroupMembers(groupId, userIds, job))
+            while not task.done():
+                await asyncio.wait([task], timeout=1)
+                if not task.done(): await self.redis.writeJob(job['id'], job, self.jobExpire)
+            try:
+                task.result()
+                job['status'] = 'failed' if job['failed'] else 'completed'
+            except Exception as e:
+                job['status'] = 'failed'
+                job['results'].append({'id': groupId, 'action': 'search', 'status': 'error', 'message': str(e)})
+            await self.redis.writeJob(job['id'], job, self.jobExpire)
+
+        await runBackground(runJob())
+        return job
 
     async def login(self, username:str, password:str):
         return await self.keycloak.login(self.tenant, self.tenant, username, password)
 
     async def logout(self, refreshToken:str):
-        return await self.keycloak.logout(self.tenant, self.tenant, refreshToken)
+        result = await self.keycloak.logout(self.tenant, self.tenant, refreshToken)
+        try: await self.redis.publishInvalidation(getTokenClaims(refreshToken)['sid'])
+        except Exception as e: LOG.DEBUG(e)
+        return result
+
+    async def invalidateAuthInfo(self):
+        try: await self.redis.publishInvalidation()
+        except Exception as e: LOG.DEBUG(e)
 
     async def getUserInfo(self, token):
         userInfo = await self.keycloak.getUserInfo(self.tenant, token.credentials)
@@ -85,39 +220,19 @@ class Control(BaseControl):
         if not authInfo:
             userInfo = await self.getUserInfo(token)
             groups = userInfo['groups']
-            aclRead = []
-            aclCreate = []
-            aclUpdate = []
-            aclDelete = []
+            acl = {}
             if self.adminRoleName in groups: admin = True
             else:
                 admin = False
-                for roleName in groups:
-                    role = await self.keycloak.readRoleByName(self.tenant, roleName)
-                    rAclRead = []
-                    rAclCreate = []
-                    rAclUpdate = []
-                    rAclDelete = []
-                    for sref, crud in role['attributes'].items():
-                        crud = crud[0]
-                        if 'c' in crud: rAclCreate.append(sref)
-                        if 'r' in crud: rAclRead.append(sref)
-                        if 'u' in crud: rAclUpdate.append(sref)
-                        if 'd' in crud: rAclDelete.append(sref)
-                    aclRead = mergeArray(aclRead, rAclRead)
-                    aclCreate = mergeArray(aclCreate, rAclCreate)
-                    aclUpdate = mergeArray(aclUpdate, rAclUpdate)
-                    aclDelete = mergeArray(aclDelete, rAclDelete)
+                for roleAcl in (await self.getRoleAcls(groups)).values():
+                    for sref, crud in roleAcl.items(): acl[sref] = acl.get(sref, 0) | CRUD.compile(crud)
             authInfo = {
                 'id': userInfo['id'],
                 'username': userInfo['username'],
                 'email': userInfo['email'],
                 'admin': admin,
                 'groups': groups,
-                'aclRead': aclRead,
-                'aclCreate': aclCreate,
-                'aclUpdate': aclUpdate,
-                'aclDelete': aclDelete
+                'acl': acl
             }
             await self.redis.write(token.credentials, authInfo)
         return AuthInfo(**authInfo)
@@ -9,10 +9,11 @@ except: pass
 #===============================================================================
 # Import
 #===============================================================================
-from typing import Annotated
-from fastapi import Query
-from common import EpException, AUTH_HEADER, ModelStatus, getNewsAndDelsArray
-from common import LoginRequest, UserInfo, AuthInfo, User, Group, AccessControl
+from typing import Annotated, Literal
+from fastapi import Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from common import EpException, AUTH_HEADER, ModelStatus
+from common import LoginRequest, UserInfo, AuthInfo, User, Group, AccessControl, MembershipResult, MembershipJob
 from .controls import Control
 
 #===============================================================================
@@ -86,15 +87,21 @@ async def read_user_by_username(token: AUTH_HEADER, username:str) -> User:
 @api.get(f'{ctrl.uriver}/user', tags=['User'])
 async def search_user_list(
     token:AUTH_HEADER,
-    search:Annotated[str | None, Query(alias='$search', description='searching keyword')]=None
+    response:Response,
+    search:Annotated[str | None, Query(alias='$search', description='searching keyword')]=None,
+    size:Annotated[int | None, Query(alias='$size', description='retrieving user count')]=None,
+    skip:Annotated[int | None, Query(alias='$skip', description='skipping user count')]=None,
+    cursor:Annotated[str | None, Query(alias='$cursor', description='cursor from X-Next-Cursor header')]=None,
+    stream:Annotated[Literal['true', 'false', ''], Query(alias='$stream', description='stream all users as ndjson')]=None
 ) -> list[User]:
     (await ctrl.getAuthInfo(token)).checkRead('User')
-    result = []
-    for user in await ctrl.keycloak.searchUsers(ctrl.tenant, search):
-        user['sref'] = 'User'
-        user['uref'] = f'{ctrl.uriver}/users/{user["id"]}'
-        result.append(user)
-    return result
+    if stream == 'true': return StreamingResponse(ctrl.exportUsers(search), media_type='application/x-ndjson')
+    if cursor: skip = ctrl.decodeCursor(cursor)
+    users = [ctrl.toUser(user) for user in await ctrl.keycloak.searchUsers(ctrl.tenant, search, skip, size)]
+    if size:
+        response.headers['X-Total-Count'] = str(await ctrl.countUsers(search))
+        if len(users) >= size: response.headers['X-Next-Cursor'] = ctrl.encodeCursor((skip if skip else 0) + len(users))
+    return users
 
 
 @api.post(f'{ctrl.uriver}/user', tags=['User'])
@@ -107,6 +114,7 @@ async def create_user(token: AUTH_HEADER, user:User) -> User:
     await ctrl.keycloak.unsetUserRoles(ctrl.tenant, userId, await ctrl.keycloak.getUserRoles(ctrl.tenant, userId))
     await ctrl.keycloak.setUserEnabled(ctrl.tenant, userId, True)
     await ctrl.keycloak.setUserToGroup(ctrl.tenant, userId, ctrl.userGroupId)
+    await ctrl.redis.delCounts('user')
     user['sref'] = 'User'
     user['uref'] = f'{ctrl.uriver}/users/{userId}'
     return user
@@ -129,6 +137,7 @@ async def update_user(token: AUTH_HEADER, userId:str, _user:User) -> User:
 async def delete_user(token: AUTH_HEADER, userId:str) -> ModelStatus:
     (await ctrl.getAuthInfo(token)).checkDelete('User')
     await ctrl.keycloak.deleteUser(ctrl.tenant, userId)
+    await ctrl.redis.delCounts('user')
     return {
         'id': userId,
         'sref': 'User',
@@ -230,24 +239,21 @@ async def read_group_users_by_code(token: AUTH_HEADER, groupCode:str) -> list[Us
 @api.get(f'{ctrl.uriver}/group', tags=['Group'])
 async def search_group_list(
     token:AUTH_HEADER,
-    search:Annotated[str | None, Query(alias='$search', description='searching keyword')]=None
+    response:Response,
+    search:Annotated[str | None, Query(alias='$search', description='searching keyword')]=None,
+    size:Annotated[int | None, Query(alias='$size', description='retrieving group count')]=None,
+    skip:Annotated[int | None, Query(alias='$skip', description='skipping group count')]=None,
+    cursor:Annotated[str | None, Query(alias='$cursor', description='cursor from X-Next-Cursor header')]=None,
+    stream:Annotated[Literal['true', 'false', ''], Query(alias='$stream', description='stream all groups as ndjson')]=None
 ) -> list[Group]:
     (await ctrl.getAuthInfo(token)).checkRead('Group')
-    result = []
-    groups = await ctrl.keycloak.searchGroups(ctrl.tenant, search)
-    for group in groups:
-        groupId = group['id']
-        result.append({
-            'id': groupId,
-            'parentId': group['parentId'] if 'parentId' in group else '',
-            'sref': 'Group',
-            'uref': f'{ctrl.uriver}/groups/{groupId}',
-            'code': group['realmRoles'][0] if group['realmRoles'] else '',
-            'name': group['name'],
-            'path': group['path'],
-            'subGroupCount': group['subGroupCount']
-        })
-    return result
+    if stream == 'true': return StreamingResponse(ctrl.exportGroups(search), media_type='application/x-ndjson')
+    if cursor: skip = ctrl.decodeCursor(cursor)
+    groups = [ctrl.toGroup(group) for group in await ctrl.keycloak.searchGroups(ctrl.tenant, search, skip, size)]
+    if size:
+        response.headers['X-Total-Count'] = str(await ctrl.countGroups(search))
+        if len(groups) >= size: response.headers['X-Next-Cursor'] = ctrl.encodeCursor((skip if skip else 0) + len(groups))
+    return groups
 
 
 @api.post(f'{ctrl.uriver}/group', tags=['Group'])
@@ -264,11 +270,13 @@ async def create_group(token: AUTH_HEADER, group:Group) -> Group:
     await ctrl.minio.createPolicy(group.code, f'g.{group.code}.*/*')
     await ctrl.keycloak.createRole(ctrl.tenant, group.code, groupName)
     role = await ctrl.keycloak.readRoleByName(ctrl.tenant, group.code)
+    await ctrl.syncRoleAcl(role)
     await ctrl.keycloak.createGroup(ctrl.tenant, groupName)
     group = await ctrl.keycloak.readGroupByName(ctrl.tenant, groupName)
     await ctrl.keycloak.setGroupRoles(ctrl.tenant, group['id'], [role])
     group = await ctrl.keycloak.readGroupByName(ctrl.tenant, groupName)
     groupId = group['id']
+    await ctrl.redis.delCounts('group')
     return {
         'id': groupId,
         'parentId': group['parentId'] if 'parentId' in group else '',
@@ -311,25 +319,31 @@ async def update_group_acl(token: AUTH_HEADER, groupId:str, accessControlList:li
     role = await ctrl.keycloak.readRoleByName(ctrl.tenant, code)
     role['attributes'] = attributes
     await ctrl.keycloak.updateRole(ctrl.tenant, role)
+    await ctrl.syncRoleAcl(role)
+    await ctrl.invalidateAuthInfo()
     return accessControlList
 
 
 @api.put(f'{ctrl.uriver}/group/{{groupId}}/user', tags=['Group'])
-async def update_group_users(token: AUTH_HEADER, groupId:str, users:list[User]) -> list[User]:
+async def update_group_users(
+    token: AUTH_HEADER,
+    groupId:str,
+    users:list[User],
+    background:Annotated[Literal['true', 'false', ''], Query(alias='$async', description='run as background job and return 202 with job status')]=None
+) -> list[MembershipResult]:
     (await ctrl.getAuthInfo(token)).checkUpdate('Group')
-    news, dels = getNewsAndDelsArray(
-        [user.id for user in users],
-        [user['id'] for user in await ctrl.keycloak.searchUsersByGroupId(ctrl.tenant, groupId)]
-    )
-    isError = False
-    for userId in news:
-        try: await ctrl.keycloak.setUserToGroup(ctrl.tenant, userId, groupId)
-        except: isError = True
-    for userId in dels:
-        try: await ctrl.keycloak.unsetUserFromGroup(ctrl.tenant, userId, groupId)
-        except: isError = True
-    if isError: raise EpException(409, 'Conflict')
-    return users
+    userIds = [user.id for user in users]
+    if background == 'true': return JSONResponse(MembershipJob(**(await ctrl.startGroupMembersJob(groupId, userIds))).model_dump(), status_code=202)
+    results = [MembershipResult(**result).model_dump() for result in await ctrl.updateGroupMembers(groupId, userIds)]
+    return JSONResponse(results, status_code=409 if any(result['status'] != 'ok' for result in results) else 200)
+
+
+@api.get(f'{ctrl.uriver}/group/{{groupId}}/user/job/{{jobId}}', tags=['Group'])
+async def get_group_users_job(token: AUTH_HEADER, groupId:str, jobId:str) -> MembershipJob:
+    (await ctrl.getAuthInfo(token)).checkUpdate('Group')
+    job = await ctrl.redis.readJob(jobId)
+    if not job or job['groupId'] != groupId: raise EpException(404, 'Not Found')
+    return MembershipJob(**job)
 
 
 @api.delete(f'{ctrl.uriver}/group/{{groupId}}', tags=['Group'])
@@ -338,7 +352,10 @@ async def delete_group(token: AUTH_HEADER, groupId:str) -> ModelStatus:
     group = await ctrl.keycloak.readGroup(ctrl.tenant, groupId)
     code = group['realmRoles'][0] if group['realmRoles'] else ''
     await ctrl.keycloak.deleteGroup(ctrl.tenant, groupId)
+    await ctrl.redis.delCounts('group')
     await ctrl.keycloak.deleteRoleByName(ctrl.tenant, code)
+    await ctrl.redis.delRoleAcl(code)
+    await ctrl.invalidateAuthInfo()
     await ctrl.minio.deletePolicy(code)
     return {
         'id': groupId,
@@ -9,7 +9,7 @@ except: pass
 #===============================================================================
 # Import
 #===============================================================================
-from .auth import SystemToken, LoginRequest, UserInfo, AuthInfo, User, Group, AccessControl
+from .auth import SystemToken, LoginRequest, UserInfo, AuthInfo, User, Group, AccessControl, MembershipResult, MembershipJob
 
 from .constants import AUTH_HEADER, TEST_HEADER, SECONDS, CRUD, LAYER, AAA
 
@@ -34,3 +34,4 @@ from .utils import Logger
 from .utils import getEnvironment, setEnvironment, getConfig
 from .utils import mergeArray, getNewsAndDelsArray, getSharesArray
 from .utils import getTStamp, getRandomString, getRandomLower, getRandomUpper, encodeBase64, decodeBase64
+from .utils import getTokenClaims
@@ -9,7 +9,9 @@ except: pass
 #===============================================================================
 # Import
 #===============================================================================
-from pydantic import BaseModel
+from typing import Any
+from pydantic import BaseModel, PrivateAttr, computed_field, model_validator
+from .constants import CRUD
 from .exceptions import EpException
 
 
@@ -46,10 +48,40 @@ class AuthInfo(BaseModel):
     email: str
     admin: bool
     groups: list[str] = []
-    aclRead: list[str] = []
-    aclCreate: list[str] = []
-    aclUpdate: list[str] = []
-    aclDelete: list[str] = []
+    acl: dict[str, int] = {}
+
+    _groupSet: frozenset = PrivateAttr(frozenset())
+
+    @model_validator(mode='before')
+    @classmethod
+    def __compile_acl__(cls, data:Any):
+        if isinstance(data, dict) and 'acl' not in data:
+            acl = {}
+            for field, crud in (('aclCreate', CRUD.C), ('aclRead', CRUD.R), ('aclUpdate', CRUD.U), ('aclDelete', CRUD.D)):
+                if field in data:
+                    for sref in data[field]: acl[sref] = acl.get(sref, 0) | crud
+            data = dict(data)
+            data['acl'] = acl
+        return data
+
+    def model_post_init(self, __context:Any):
+        self._groupSet = frozenset(self.groups)
+
+    @computed_field
+    @property
+    def aclRead(self) -> list[str]: return [sref for sref, crud in self.acl.items() if crud & CRUD.R]
+
+    @computed_field
+    @property
+    def aclCreate(self) -> list[str]: return [sref for sref, crud in self.acl.items() if crud & CRUD.C]
+
+    @computed_field
+    @property
+    def aclUpdate(self) -> list[str]: return [sref for sref, crud in self.acl.items() if crud & CRUD.U]
+
+    @computed_field
+    @property
+    def aclDelete(self) -> list[str]: return [sref for sref, crud in self.acl.items() if crud & CRUD.D]
 
     def checkAdmin(self):
         if self.admin: return self
@@ -64,43 +96,43 @@ class AuthInfo(BaseModel):
         raise EpException(403, 'Forbidden')
 
     def checkGroup(self, group):
-        if self.admin or group in self.groups: return self
+        if self.admin or group in self._groupSet: return self
         raise EpException(403, 'Forbidden')
 
     def checkOnlyGroup(self, group):
-        if group in self.groups: return group
+        if group in self._groupSet: return group
         raise EpException(403, 'Forbidden')
 
     def checkRead(self, sref):
-        if self.admin or sref in self.aclRead: return self
+        if self.admin or self.acl.get(sref, 0) & CRUD.R: return self
         raise EpException(403, 'Forbidden')
 
     def checkOnlyRead(self, sref):
-        if sref in self.aclRead: return sref
+        if self.acl.get(sref, 0) & CRUD.R: return sref
         raise EpException(403, 'Forbidden')
 
     def checkCreate(self, sref):
-        if self.admin or sref in self.aclCreate: return self
+        if self.admin or self.acl.get(sref, 0) & CRUD.C: return self
         raise EpException(403, 'Forbidden')
 
     def checkOnlyCreate(self, sref):
-        if sref in self.aclCreate: return sref
+        if self.acl.get(sref, 0) & CRUD.C: return sref
         raise EpException(403, 'Forbidden')
 
     def checkUpdate(self, sref):
-        if self.admin or sref in self.aclUpdate: return self
+        if self.admin or self.acl.get(sref, 0) & CRUD.U: return self
         raise EpException(403, 'Forbidden')
 
     def checkOnlyUpdate(self, sref):
-        if sref in self.aclUpdate: return sref
+        if self.acl.get(sref, 0) & CRUD.U: return sref
         raise EpException(403, 'Forbidden')
 
     def checkDelete(self, sref):
-        if self.admin or sref in self.aclDelete: return self
+        if self.admin or self.acl.get(sref, 0) & CRUD.D: return self
         raise EpException(403, 'Forbidden')
 
     def checkOnlyDelete(self, sref):
-        if sref in self.aclDelete: return sref
+        if self.acl.get(sref, 0) & CRUD.D: return sref
         raise EpException(403, 'Forbidden')
 
 
@@ -131,3 +163,22 @@ class AccessControl(BaseModel):
 
     sref:str
     crud:str
+
+
+class MembershipResult(BaseModel):
+
+    id:str
+    action:str
+    status:str
+    message:str = ''
+
+
+class MembershipJob(BaseModel):
+
+    id:str
+    groupId:str
+    status:str
+    total:int = 0
+    done:int = 0
+    failed:int = 0
+    results:list[MembershipResult] = []
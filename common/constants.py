@@ -83,6 +83,9 @@ class CRUD:
     @classmethod
     def checkDelete(cls, crud): return True if crud & 8 else False
 
+    @classmethod
+    def compile(cls, crud:str): return (1 if 'c' in crud else 0) | (2 if 'r' in crud else 0) | (4 if 'u' in crud else 0) | (8 if 'd' in crud else 0)
+
 
 class LAYER:
 
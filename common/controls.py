@@ -10,6 +10,9 @@ except: pass
 # Import
 #===============================================================================
 import os
+import asyncio
+import hashlib
+from collections import OrderedDict
 from typing import Annotated, Any, List, Literal
 from pydantic import BaseModel
 from stringcase import pathcase
@@ -23,8 +26,18 @@ from .constants import CRUD, LAYER, AAA, AUTH_HEADER
 from .exceptions import EpException
 from .interfaces import AsyncRest
 from .models import ID, Search, BaseSchema, ServiceHealth, ModelStatus, ModelCount
-from .schedules import runBackground
-from .utils import setEnvironment, getConfig, Logger, getTStamp
+from .schedules import asleep, runBackground
+from .utils import setEnvironment, getConfig, Logger, getTStamp, getTokenClaims
+
+try: import jwt
+except: jwt = None
+
+
+#===============================================================================
+# Constants
+#===============================================================================
+_SYSTEM_TOKEN_MARGIN = 60
+_SYSTEM_TOKEN_REFRESH = 300
 
 
 #===============================================================================
@@ -117,6 +130,7 @@ class BaseControl:
     async def __shutdown__(self):
         LOG.INFO(f'{self.module} stop controller')
         await self.shutdown()
+        await AsyncRest.closeSessions()
         LOG.INFO(f'{self.module} controller is finished')
 
     async def startup(self): pass
@@ -139,28 +153,177 @@ class SessionControl(BaseControl):
         self.accountBaseUrl = f'http://{accHostname}:{accHostport}/{accHostname}/v{self.version}'
         self.accountCache = accountCacheDriver(self)
 
+        kcConf = self.config['keycloak']
+        raConf = self.config['redis:account']
+        self.keycloakCertsUrl = f"http://{kcConf['hostname']}:{kcConf['hostport']}/auth/realms/{self.tenant}/protocol/openid-connect/certs"
+        self.keycloakIssuers = [f'https://{self.endpoint}/auth/realms/{self.tenant}', f"http://{kcConf['hostname']}:{kcConf['hostport']}/auth/realms/{self.tenant}"]
+        self.keycloakCertsRefresh = int(kcConf['certs_refresh']) if 'certs_refresh' in kcConf and kcConf['certs_refresh'] else 300
+        self.roleAclRefresh = int(raConf['acl_refresh']) if 'acl_refresh' in raConf and raConf['acl_refresh'] else 10
+        self.keycloakCerts = {}
+        self.roleAcls = {}
+
+        self.authInfoExpire = int(raConf['expire'])
+        self.authInfoMaxKeys = int(raConf['local_maxkeys']) if 'local_maxkeys' in raConf and raConf['local_maxkeys'] else 10000
+        self.authInfoCache = OrderedDict()
+        self.authInfoGeneration = 0
+        self.revokedSessionExpire = int(kcConf['token_lifespan']) if 'token_lifespan' in kcConf and kcConf['token_lifespan'] else 900
+        self.revokedSessions = {}
+
+        self.systemToken = None
+        self.systemTokenExpireAt = 0
+
     async def __startup__(self):
         await self.accountCache.connect()
+        if jwt:
+            await runBackground(self.__syncKeycloakCerts__())
+            await runBackground(self.__syncRoleAcls__())
+        if jwt or self.authInfoMaxKeys > 0: await runBackground(self.__listenAuthInfoInvalidation__())
+        await runBackground(self.__listenSystemToken__())
+        await runBackground(self.__refreshSystemToken__())
         await BaseControl.__startup__(self)
 
     async def __shutdown__(self):
         await BaseControl.__shutdown__(self)
         await self.accountCache.disconnect()
 
+    def __set_system_token__(self, systemToken:str):
+        try: expireAt = int(getTokenClaims(systemToken)['exp'])
+        except: expireAt = getTStamp() + _SYSTEM_TOKEN_MARGIN
+        self.systemToken = SystemToken(credentials=systemToken)
+        self.systemTokenExpireAt = expireAt
+        return self.systemToken
+
+    async def __listenSystemToken__(self):
+        while True:
+            try:
+                async for systemToken in self.accountCache.listenSystemToken(): self.__set_system_token__(systemToken)
+            except Exception as e: LOG.DEBUG(f'system token listener stopped: {e}')
+            await asleep(1)
+
+    async def __refreshSystemToken__(self):
+        while True:
+            try:
+                systemToken = await self.accountCache.getSystemToken()
+                if systemToken: self.__set_system_token__(systemToken)
+            except Exception as e: LOG.DEBUG(f'could not refresh system token: {e}')
+            await asleep(max(1, min(_SYSTEM_TOKEN_REFRESH, self.systemTokenExpireAt - getTStamp() - _SYSTEM_TOKEN_MARGIN)))
+
     async def getSystemToken(self):
+        if self.systemToken and self.systemTokenExpireAt - _SYSTEM_TOKEN_MARGIN > getTStamp(): return self.systemToken
         systemToken = await self.accountCache.getSystemToken()
-        if systemToken: return SystemToken(credentials=systemToken)
+        if systemToken: return self.__set_system_token__(systemToken)
         raise EpException(500, 'Internal Server Error')
 
     async def getClientSecret(self, clientId:str) -> str:
         token = await self.getSystemToken()
         async with AsyncRest(self.accountBaseUrl) as req: return await req.get(f'/client/{clientId}/secret', headers={'Authorization': f'{token.scheme} {token.credentials}'})
 
+    async def __syncKeycloakCerts__(self):
+        while True:
+            try:
+                async with AsyncRest() as req: certs = await req.get(self.keycloakCertsUrl)
+                keycloakCerts = {}
+                for cert in certs['keys']:
+                    if cert.get('use') == 'sig' and 'kid' in cert:
+                        try: keycloakCerts[cert['kid']] = jwt.PyJWK(cert)
+                        except Exception as e: LOG.DEBUG(e)
+                self.keycloakCerts = keycloakCerts
+            except Exception as e: LOG.DEBUG(f'could not sync keycloak certs: {e}')
+            await asleep(self.keycloakCertsRefresh)
+
+    async def __syncRoleAcls__(self):
+        while True:
+            try: self.roleAcls = await self.accountCache.getRoleAcls()
+            except Exception as e: LOG.DEBUG(f'could not sync role acls: {e}')
+            await asleep(self.roleAclRefresh)
+
+    async def __listenAuthInfoInvalidation__(self):
+        while True:
+            try:
+                async for sessionId in self.accountCache.listenInvalidation():
+                    if sessionId == '*':
+                        if jwt:
+                            try: self.roleAcls = await self.accountCache.getRoleAcls()
+                            except Exception as e: LOG.DEBUG(f'could not reload role acls: {e}')
+                        self.authInfoGeneration += 1
+                        self.authInfoCache.clear()
+                    else: self.__revoke_session__(sessionId)
+            except Exception as e: LOG.DEBUG(f'authinfo invalidation listener stopped: {e}')
+            self.authInfoGeneration += 1
+            self.authInfoCache.clear()
+            await asleep(1)
+
+    def __revoke_session__(self, sessionId:str):
+        now = getTStamp()
+        for sid in [sid for sid, expireAt in self.revokedSessions.items() if expireAt <= now]: self.revokedSessions.pop(sid, None)
+        self.revokedSessions[sessionId] = now + self.revokedSessionExpire
+        self.authInfoGeneration += 1
+        for key in [key for key, (_, sid, _) in self.authInfoCache.items() if sid == sessionId]: self.authInfoCache.pop(key, None)
+
+    def __is_revoked__(self, sessionId:str | None) -> bool:
+        if not sessionId or sessionId not in self.revokedSessions: return False
+        if self.revokedSessions[sessionId] > getTStamp(): return True
+        self.revokedSessions.pop(sessionId, None)
+        return False
+
+    def __get_auth_info__(self, key:str) -> AuthInfo | None:
+        entry = self.authInfoCache.get(key)
+        if entry:
+            if entry[0] > getTStamp() and not self.__is_revoked__(entry[1]):
+                self.authInfoCache.move_to_end(key)
+                return entry[2]
+            self.authInfoCache.pop(key, None)
+        return None
+
+    def __set_auth_info__(self, key:str, bearerToken:str, authInfo:AuthInfo):
+        try:
+            claims = getTokenClaims(bearerToken)
+            expireAt = min(int(claims['exp']), getTStamp() + self.authInfoExpire)
+            sessionId = claims['sid'] if 'sid' in claims else None
+        except: return
+        self.authInfoCache[key] = (expireAt, sessionId, authInfo)
+        self.authInfoCache.move_to_end(key)
+        while len(self.authInfoCache) > self.authInfoMaxKeys: self.authInfoCache.popitem(last=False)
+
+    def verifyBearerToken(self, bearerToken:str) -> AuthInfo | None:
+        if not jwt or not self.keycloakCerts: return None
+        try:
+            cert = self.keycloakCerts[jwt.get_unverified_header(bearerToken)['kid']]
+            claims = jwt.decode(bearerToken, cert.key, algorithms=[cert.algorithm_name], options={'verify_aud': False, 'require': ['exp', 'sub', 'iss']})
+            if claims['iss'] not in self.keycloakIssuers or 'typ' not in claims or claims['typ'] != 'Bearer': return None
+            if 'sid' in claims and self.__is_revoked__(claims['sid']): raise EpException(401, 'Unauthorized')
+            groups = claims['groups']
+            acl = {}
+            if self.adminRoleName in groups: admin = True
+            else:
+                admin = False
+                for roleName in groups:
+                    for sref, crud in self.roleAcls[roleName].items(): acl[sref] = acl.get(sref, 0) | CRUD.compile(crud)
+            return AuthInfo(
+                id=claims['sub'],
+                username=claims['preferred_username'],
+                email=claims['email'] if 'email' in claims else '',
+                admin=admin,
+                groups=groups,
+                acl=acl
+            )
+        except EpException: raise
+        except Exception: return None
+
     async def checkBearerToken(self, bearerToken:str) -> AuthInfo:
-        authInfo = await self.accountCache.read(bearerToken)
+        generation = self.authInfoGeneration
+        if self.authInfoMaxKeys > 0:
+            key = hashlib.sha256(bearerToken.encode('utf-8')).hexdigest()
+            authInfo = self.__get_auth_info__(key)
+            if authInfo: return authInfo
+        authInfo = self.verifyBearerToken(bearerToken)
         if not authInfo:
-            async with AsyncRest(self.accountBaseUrl) as req: authInfo = await req.get('/authinfo', headers={'Authorization': f'Bearer {bearerToken}'})
-        return AuthInfo(**authInfo)
+            authInfo = await self.accountCache.read(bearerToken)
+            if not authInfo:
+                async with AsyncRest(self.accountBaseUrl) as req: authInfo = await req.get('/authinfo', headers={'Authorization': f'Bearer {bearerToken}'})
+            authInfo = AuthInfo(**authInfo)
+        if self.authInfoMaxKeys > 0 and generation == self.authInfoGeneration: self.__set_auth_info__(key, bearerToken, authInfo)
+        return authInfo
 
     async def checkAuthorization(self, token:HTTPAuthorizationCredentials) -> AuthInfo:
         return await self.checkBearerToken(token.credentials)
@@ -412,6 +575,11 @@ class UerpControl(SessionControl):
         self.schemaInfoList = []
         self.schemaInfoMap = {}
 
+        rmConf = self.config['redis:model']
+        self.warmupTimeout = int(rmConf['warmup_timeout']) if 'warmup_timeout' in rmConf and rmConf['warmup_timeout'] else 60
+        self.warmupConcurrency = int(rmConf['warmup_concurrency']) if 'warmup_concurrency' in rmConf and rmConf['warmup_concurrency'] else 1
+        self.warmupFinished = False
+
     async def __startup__(self):
         await self.database.initialize()
         await self.search.initialize()
@@ -422,7 +590,18 @@ class UerpControl(SessionControl):
             path=f'{self.uriver}/schema',
             endpoint=self.getSchemaInfo, response_model=dict, tags=['Schema'], name='Get Schema Info'
         )
+        self.api.add_api_route(
+            methods=['GET'],
+            path='/internal/cache',
+            endpoint=self.getCacheStats, response_model=list, tags=['Internal'], name='Cache Stats'
+        )
+        self.api.add_api_route(
+            methods=['DELETE'],
+            path='/internal/cache/{sref}',
+            endpoint=self.flushCache, response_model=dict, tags=['Internal'], name='Flush Cache'
+        )
         await SessionControl.__startup__(self)
+        await runBackground(self.__warmupCache__())
 
     async def __shutdown__(self):
         await SessionControl.__shutdown__(self)
@@ -431,6 +610,39 @@ class UerpControl(SessionControl):
         await self.cache.disconnect()
         await self.queue.disconnect()
 
+    async def health(self) -> ServiceHealth:
+        if self.warmupFinished: return ServiceHealth(title=self.module, status='OK', healthy=True)
+        return ServiceHealth(title=self.module, status='WARMUP', healthy=False)
+
+    async def __warmupCache__(self):
+        semaphore = asyncio.Semaphore(self.warmupConcurrency)
+
+        async def warmup(schemaInfo):
+            try: locked = await self.cache.lockWarmup(schemaInfo, self.warmupTimeout)
+            except Exception as e:
+                LOG.WARN(f'could not lock cache warm up of {schemaInfo.sref}: {e}')
+                return
+            if not locked:
+                try:
+                    while not await self.cache.checkWarmup(schemaInfo): await asleep(1)
+                except Exception as e: LOG.WARN(f'could not wait for cache warm up of {schemaInfo.sref}: {e}')
+                return
+            async with semaphore:
+                search = Search(orderBy='tstamp', order='desc', size=schemaInfo.cache['warmup'])
+                try:
+                    if LAYER.checkSearch(schemaInfo.layer): models = await self.search.search(schemaInfo, search)
+                    else: models = await self.database.search(schemaInfo, search)
+                    if models: await self.cache.create(schemaInfo, *models)
+                except Exception as e: LOG.WARN(f'could not warm up cache of {schemaInfo.sref}: {e}')
+                else: LOG.INFO(f'warm up cache of {schemaInfo.sref} with {len(models)} models')
+                try: await self.cache.setWarmup(schemaInfo)
+                except Exception as e: LOG.DEBUG(e)
+
+        schemaInfoList = [schemaInfo for schemaInfo in self.schemaInfoList if LAYER.checkCache(schemaInfo.layer) and (LAYER.checkSearch(schemaInfo.layer) or LAYER.checkDatabase(schemaInfo.layer)) and schemaInfo.cache.get('warmup')]
+        try: await asyncio.wait_for(asyncio.gather(*[warmup(schemaInfo) for schemaInfo in schemaInfoList]), self.warmupTimeout)
+        except asyncio.TimeoutError: LOG.WARN(f'cache warm up is timed out after {self.warmupTimeout} seconds')
+        self.warmupFinished = True
+
     async def publishToRouter(self, publish, category, target, status, data):
         if True if publish == '' or publish == 'true' else False: await runBackground(self.__publishToRouter__(category, target, data['id'], data['sref'], data['uref'], status))
 
@@ -563,6 +775,14 @@ class UerpControl(SessionControl):
             }
         return desc
 
+    async def getCacheStats(self) -> list:
+        return [await self.cache.stats(schemaInfo) for schemaInfo in self.schemaInfoList if LAYER.checkCache(schemaInfo.layer)]
+
+    async def flushCache(self, sref:str) -> dict:
+        for schemaInfo in self.schemaInfoList:
+            if schemaInfo.sref == sref and LAYER.checkCache(schemaInfo.layer): return {'sref': sref, 'flushed': await self.cache.flush(schemaInfo)}
+        raise EpException(404, 'Not Found')
+
     async def readModelByAuthnUser(self, request:Request, token: AUTH_HEADER, id:ID):
         id = str(id)
         uref = request.scope['path']
@@ -610,28 +830,38 @@ class UerpControl(SessionControl):
         return await self.readModel(schemaInfo, id)
 
     async def readModel(self, schemaInfo, id):
+        notFound = True
         if LAYER.checkCache(schemaInfo.layer):
-            try:
-                model = await self.cache.read(schemaInfo, id)
-                if model: return model
-            except: pass
+            try: model = await self.cache.read(schemaInfo, id)
+            except: model = None
+            if model: return model
+            elif model is False: raise EpException(404, 'Not Found')
         if LAYER.checkSearch(schemaInfo.layer):
             try:
                 model = await self.search.read(schemaInfo, id)
                 if model:
-                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, model))
+                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.admit(schemaInfo, model, counted=True))
                     return model
-            except: pass
+            except: notFound = False
         if LAYER.checkDatabase(schemaInfo.layer):
             try:
                 model = await self.database.read(schemaInfo, id)
                 if model:
-                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, model))
+                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.admit(schemaInfo, model, counted=True))
                     if LAYER.checkSearch(schemaInfo.layer): await runBackground(self.search.create(schemaInfo, model))
                     return model
-            except: pass
+            except: notFound = False
+        if notFound and LAYER.checkCache(schemaInfo.layer): await runBackground(self.__setNotFound__(schemaInfo, id))
         raise EpException(404, 'Not Found')
 
+    async def __setNotFound__(self, schemaInfo, id):
+        try: await self.cache.setNotFound(schemaInfo, id)
+        except: pass
+
+    async def __clearNotFound__(self, schemaInfo, id):
+        try: await self.cache.clearNotFound(schemaInfo, id)
+        except: pass
+
     async def searchModelsByAuthnUser(
         self,
         request:Request,
@@ -851,11 +1081,11 @@ class UerpControl(SessionControl):
                     except LookupError: raise EpException(400, 'Bad Request')
                     except Exception: raise EpException(503, 'Service Unavailable')
                     else:
-                        if models and LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, *models))
+                        if models and LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.admit(schemaInfo, *models))
                 else: raise EpException(503, 'Service Unavailable')
             else:
                 if models:
-                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, *models))
+                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.admit(schemaInfo, *models))
                     if LAYER.checkSearch(schemaInfo.layer): await runBackground(self.search.create(schemaInfo, *models))
             return models
         elif LAYER.checkSearch(schemaInfo.layer):
@@ -868,11 +1098,11 @@ class UerpControl(SessionControl):
                     except Exception: raise EpException(503, 'Service Unavailable')
                     else:
                         if models:
-                            if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, *models))
+                            if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.admit(schemaInfo, *models))
                             if LAYER.checkSearch(schemaInfo.layer): await runBackground(self.search.create(schemaInfo, *models))
                 else: raise EpException(503, 'Service Unavailable')
             else:
-                if models and LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, *models))
+                if models and LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.admit(schemaInfo, *models))
             return models
 
         raise EpException(501, 'Not Implemented')
@@ -1166,7 +1396,9 @@ class UerpControl(SessionControl):
             except Exception: raise EpException(503, 'Service Unavailable')
             else:
                 if result:
-                    if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, data))
+                    if LAYER.checkCache(schemaInfo.layer):
+                        await self.__clearNotFound__(schemaInfo, data['id'])
+                        await runBackground(self.cache.create(schemaInfo, data))
                     if LAYER.checkSearch(schemaInfo.layer): await runBackground(self.search.create(schemaInfo, data))
                     return data
                 else: raise EpException(409, 'Conflict')
@@ -1175,7 +1407,9 @@ class UerpControl(SessionControl):
             except LookupError as e: LOG.ERROR(e); raise EpException(400, 'Bad Request')
             except Exception as e: LOG.ERROR(e); raise EpException(503, 'Service Unavailable')
             else:
-                if LAYER.checkCache(schemaInfo.layer): await runBackground(self.cache.create(schemaInfo, data))
+                if LAYER.checkCache(schemaInfo.layer):
+                    await self.__clearNotFound__(schemaInfo, data['id'])
+                    await runBackground(self.cache.create(schemaInfo, data))
                 return data
         elif LAYER.checkCache(schemaInfo.layer):
             try: await self.cache.create(schemaInfo, data)
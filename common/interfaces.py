@@ -22,6 +22,14 @@ from .exceptions import EpException
 #===============================================================================
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+#===============================================================================
+# Constants
+#===============================================================================
+_ASYNC_REST_POOL_LIMIT = 100
+_ASYNC_REST_POOL_LIMIT_PER_HOST = 32
+_ASYNC_REST_KEEPALIVE_TIMEOUT = 30
+_ASYNC_REST_DNS_CACHE_TTL = 300
+
 
 #===============================================================================
 # Implement
@@ -69,13 +77,41 @@ class SyncRest:
 
 class AsyncRest:
 
+    __sessions__ = {}
+
+    @classmethod
+    def getSession(cls, baseUrl=''):
+        session = cls.__sessions__[baseUrl] if baseUrl in cls.__sessions__ else None
+        if not session or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    ssl=False,
+                    limit=_ASYNC_REST_POOL_LIMIT,
+                    limit_per_host=_ASYNC_REST_POOL_LIMIT_PER_HOST,
+                    keepalive_timeout=_ASYNC_REST_KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=_ASYNC_REST_DNS_CACHE_TTL
+                ),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                raise_for_status=True
+            )
+            cls.__sessions__[baseUrl] = session
+        return session
+
+    @classmethod
+    async def closeSessions(cls):
+        sessions = list(cls.__sessions__.values())
+        cls.__sessions__.clear()
+        for session in sessions:
+            try: await session.close()
+            except: pass
+
     def __init__(self, baseUrl=''): self.baseUrl = baseUrl
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False), raise_for_status=True)
+        self.session = AsyncRest.getSession(self.baseUrl)
         return self
 
-    async def __aexit__(self, *args): await self.session.close()
+    async def __aexit__(self, *args): pass
 
     async def proxy(self, request:Request):
         method = request.scope['method']
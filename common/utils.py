@@ -10,6 +10,7 @@ except: pass
 # Import
 #===============================================================================
 import sys
+import json
 import base64
 import random
 import string
@@ -78,19 +79,14 @@ def mergeArray(arr1, arr2): return arr1 + list(set(arr2) - set(arr1))
 
 
 def getNewsAndDelsArray(new, old):
-    news = []
-    dels = []
-    for item in mergeArray(new, old):
-        if item not in old: news.append(item)
-        if item not in new: dels.append(item)
-    return (news, dels)
+    newSet = set(new)
+    oldSet = set(old)
+    return ([item for item in dict.fromkeys(new) if item not in oldSet], [item for item in dict.fromkeys(old) if item not in newSet])
 
 
 def getSharesArray(arr1, arr2):
-    shares = []
-    for item in arr1:
-        if item in arr2: shares.append(item)
-    return shares
+    arr2 = set(arr2)
+    return [item for item in arr1 if item in arr2]
 
 
 def getTStamp(): return int(time())
@@ -109,3 +105,11 @@ def encodeBase64(data): return base64.b64encode(data.encode('utf-8')).decode('as
 
 
 def decodeBase64(data): return base64.b64decode(data.encode('ascii')).decode('utf-8')
+
+
+#===============================================================================
+# Token Claims (Unverified)
+#===============================================================================
+def getTokenClaims(token:str) -> dict:
+    payload = token.split('.')[1]
+    return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
@@ -9,7 +9,14 @@ except: pass
 #===============================================================================
 # Import
 #===============================================================================
-from common import EpException, AsyncRest, DriverBase, SECONDS
+import asyncio
+from common import EpException, AsyncRest, DriverBase, SECONDS, getTStamp
+
+
+#===============================================================================
+# Constants
+#===============================================================================
+_KEYCLOAK_TOKEN_MARGIN = 30
 
 
 #===============================================================================
@@ -32,10 +39,15 @@ class KeyCloak(DriverBase):
         self.kcHeaders = None
         self.kcAccessToken = None
         self.kcRefreshToken = None
+        self.kcExpireAt = 0
+        self.kcLock = asyncio.Lock()
+        self.kcDirectory = None
+        self.kcDirectoryExpire = int(kcConf['directory_expire']) if 'directory_expire' in kcConf and kcConf['directory_expire'] else 0
 
     async def initialize(self, *args, **kargs):
         if 'defaultAcl' in kargs:
             for sref, crud in kargs['defaultAcl'].items(): self.kcDefaultAcl[sref] = [crud]
+        if 'directory' in kargs and self.kcDirectoryExpire > 0: self.kcDirectory = kargs['directory']
         await self.connect()
         try: await self.readRealm(self.control.tenant)
         except EpException as e:
@@ -62,6 +74,7 @@ class KeyCloak(DriverBase):
         else: tokens = await self.login('master', 'admin-cli', self.control.systemAccessKey, self.control.systemSecretKey)
         self.kcAccessToken = tokens['access_token']
         self.kcRefreshToken = tokens['refresh_token']
+        self.kcExpireAt = getTStamp() + int(tokens['expires_in']) if 'expires_in' in tokens else 0
         self.kcHeaders = {
             'Authorization': f'Bearer {self.kcAccessToken}',
             'Accept': 'application/json',
@@ -74,44 +87,55 @@ class KeyCloak(DriverBase):
         except: pass
         self.kcRefreshToken = None
         self.kcAccessToken = None
+        self.kcExpireAt = 0
 
     #===========================================================================
     # Basic Rest Methods
     #===========================================================================
-    async def get(self, url):
-        async with AsyncRest(self.kcBaseUrl) as s:
-            try: return await s.get(url, headers=self.kcHeaders)
-            except EpException as e:
-                if e.status_code == 401: return await (await self.connect()).get(url)
-                else: raise e
+    async def __refresh__(self, staleToken):
+        async with self.kcLock:
+            if self.kcAccessToken == staleToken or self.kcExpireAt and self.kcExpireAt - _KEYCLOAK_TOKEN_MARGIN <= getTStamp(): await self.connect()
 
-    async def post(self, url, payload):
+    async def __request__(self, method, url, **kargs):
+        if self.kcExpireAt and self.kcExpireAt - _KEYCLOAK_TOKEN_MARGIN <= getTStamp(): await self.__refresh__(self.kcAccessToken)
+        accessToken = self.kcAccessToken
         async with AsyncRest(self.kcBaseUrl) as s:
-            try: return await s.post(url, json=payload, headers=self.kcHeaders)
+            try: return await getattr(s, method)(url, headers=self.kcHeaders, **kargs)
             except EpException as e:
-                if e.status_code == 401: return await (await self.connect()).post(url, payload)
-                else: raise e
+                if e.status_code != 401: raise e
+            await self.__refresh__(accessToken)
+            return await getattr(s, method)(url, headers=self.kcHeaders, **kargs)
 
-    async def put(self, url, payload):
-        async with AsyncRest(self.kcBaseUrl) as s:
-            try: return await s.put(url, json=payload, headers=self.kcHeaders)
-            except EpException as e:
-                if e.status_code == 401: return await (await self.connect()).put(url, payload)
-                else: raise e
+    async def __cached__(self, kind, key, reader):
+        if self.kcDirectory:
+            try:
+                data = await self.kcDirectory.getDirectory(kind, key)
+                if data is not None: return data
+            except Exception as e: LOG.DEBUG(e)
+        data = await reader()
+        if self.kcDirectory:
+            try: await self.kcDirectory.setDirectory(kind, key, data, self.kcDirectoryExpire)
+            except Exception as e: LOG.DEBUG(e)
+        return data
 
-    async def patch(self, url, payload):
-        async with AsyncRest(self.kcBaseUrl) as s:
-            try: return await s.patch(url, json=payload, headers=self.kcHeaders)
-            except EpException as e:
-                if e.status_code == 401: return await (await self.connect()).patch(url, payload)
-                else: raise e
+    async def __invalidate__(self, *kinds):
+        if self.kcDirectory:
+            try: await self.kcDirectory.delDirectory(*kinds)
+            except Exception as e: LOG.DEBUG(e)
 
-    async def delete(self, url, payload=None):
-        async with AsyncRest(self.kcBaseUrl) as s:
-            try: return await s.delete(url, json=payload, headers=self.kcHeaders)
-            except EpException as e:
-                if e.status_code == 401: return await (await self.connect()).delete(url)
-                else: raise e
+    def __query__(self, prefix='?', **params):
+        query = '&'.join(f'{key}={val}' for key, val in params.items() if val is not None and val != '')
+        return f'{prefix}{query}' if query else ''
+
+    async def get(self, url): return await self.__request__('get', url)
+
+    async def post(self, url, payload): return await self.__request__('post', url, json=payload)
+
+    async def put(self, url, payload): return await self.__request__('put', url, json=payload)
+
+    async def patch(self, url, payload): return await self.__request__('patch', url, json=payload)
+
+    async def delete(self, url, payload=None): return await self.__request__('delete', url, json=payload)
 
     #===========================================================================
     # OpenId Connect
@@ -415,49 +439,60 @@ class KeyCloak(DriverBase):
 
     # Group ####################################################################
     async def readGroup(self, realmId:str, groupId:str):
-        return await self.get(f'/admin/realms/{realmId}/groups/{groupId}')
+        return await self.__cached__('group', f'{realmId}:id:{groupId}', lambda: self.get(f'/admin/realms/{realmId}/groups/{groupId}'))
 
     async def readGroupByName(self, realmId:str, groupName:str):
-        for group in await self.searchGroups(realmId, groupName):
-            if group['name'] == groupName: return group
-        else: raise EpException(404, 'Not Found')
+        async def reader():
+            for group in await self.searchGroups(realmId, groupName):
+                if group['name'] == groupName: return group
+            else: raise EpException(404, 'Not Found')
+        return await self.__cached__('group', f'{realmId}:name:{groupName}', reader)
 
-    async def searchGroups(self, realmId:str, search:str | None=None):
-        if search: return await self.get(f'/admin/realms/{realmId}/groups?briefRepresentation&search={search}')
-        else: return await self.get(f'/admin/realms/{realmId}/groups?briefRepresentation')
+    async def searchGroups(self, realmId:str, search:str | None=None, first:int | None=None, max:int | None=None):
+        return await self.get(f"/admin/realms/{realmId}/groups?briefRepresentation{self.__query__(search=search, first=first, max=max, prefix='&')}")
+
+    async def countGroups(self, realmId:str, search:str | None=None):
+        return (await self.get(f'/admin/realms/{realmId}/groups/count{self.__query__(search=search)}'))['count']
 
     async def searchGroupsByRoleId(self, realmId:str, roleId:str):
-        roleName = (await self.readRole(realmId, roleId))['name']
-        return await self.get(f'/admin/realms/{realmId}/roles/{roleName}/groups')
+        async def reader():
+            roleName = (await self.readRole(realmId, roleId))['name']
+            return await self.get(f'/admin/realms/{realmId}/roles/{roleName}/groups')
+        return await self.__cached__('group', f'{realmId}:role:{roleId}', reader)
 
     async def createGroup(self, realmId:str, name:str, attributes:dict | None=None):
         await self.post(f'/admin/realms/{realmId}/groups', {
             'name': name,
             'attributes': attributes if attributes else {}
         })
+        await self.__invalidate__('group')
 
     async def updateGroup(self, realmId:str, group:dict):
         await self.put(f'/admin/realms/{realmId}/groups/{group["id"]}', {'name': group['name']})
+        await self.__invalidate__('group')
 
     async def getGroupRoles(self, realmId:str, groupId:str):
         return await self.get(f'/admin/realms/{realmId}/groups/{groupId}/role-mappings/realm')
 
     async def setGroupRoles(self, realmId:str, groupId:str, roles:list):
         await self.post(f'/admin/realms/{realmId}/groups/{groupId}/role-mappings/realm', roles)
+        await self.__invalidate__('group')
 
     async def deleteGroup(self, realmId:str, groupId:str):
         await self.delete(f'/admin/realms/{realmId}/groups/{groupId}')
+        await self.__invalidate__('group')
 
     # Role #####################################################################
     async def readRole(self, realmId:str, roleId:str):
-        return await self.get(f'/admin/realms/{realmId}/roles-by-id/{roleId}')
+        return await self.__cached__('role', f'{realmId}:id:{roleId}', lambda: self.get(f'/admin/realms/{realmId}/roles-by-id/{roleId}'))
 
     async def readRoleByName(self, realmId:str, roleName:str):
-        return await self.get(f'/admin/realms/{realmId}/roles/{roleName}')
+        return await self.__cached__('role', f'{realmId}:name:{roleName}', lambda: self.get(f'/admin/realms/{realmId}/roles/{roleName}'))
 
-    async def searchRoles(self, realmId:str, search:str | None=None):
-        if search: return await self.get(f'/admin/realms/{realmId}/roles?search={search}')
-        else: return await self.get(f'/admin/realms/{realmId}/roles')
+    async def searchRoles(self, realmId:str, search:str | None=None, brief:bool=True):
+        brief = '' if brief else 'briefRepresentation=false'
+        if search: return await self.get(f"/admin/realms/{realmId}/roles?search={search}{'&' + brief if brief else ''}")
+        else: return await self.get(f"/admin/realms/{realmId}/roles{'?' + brief if brief else ''}")
 
     async def createRole(self, realmId:str, name:str, description:str='', attributes:dict | None=None):
         await self.post(f'/admin/realms/{realmId}/roles', {
@@ -465,31 +500,39 @@ class KeyCloak(DriverBase):
             'description': description,
             'attributes': attributes if attributes else self.kcDefaultAcl
         })
+        await self.__invalidate__('role', 'group')
 
     async def updateRole(self, realmId:str, role:dict):
         await self.put(f'/admin/realms/{realmId}/roles-by-id/{role["id"]}', role)
+        await self.__invalidate__('role', 'group')
 
     async def deleteRole(self, realmId:str, roleId:str):
         await self.delete(f'/admin/realms/{realmId}/roles-by-id/{roleId}')
+        await self.__invalidate__('role', 'group')
 
     async def deleteRoleByName(self, realmId:str, roleName:str):
         await self.delete(f'/admin/realms/{realmId}/roles/{roleName}')
+        await self.__invalidate__('role', 'group')
 
     # User #####################################################################
     async def readUser(self, realmId:str, userId:str):
-        return await self.get(f'/admin/realms/{realmId}/users/{userId}')
+        return await self.__cached__('user', f'{realmId}:id:{userId}', lambda: self.get(f'/admin/realms/{realmId}/users/{userId}'))
 
     async def readUserByUsername(self, realmId:str, username:str):
-        for user in await self.searchUsers(realmId, search=username):
-            if username == user['username']: return user
-        raise EpException(404, 'Not Found')
+        async def reader():
+            for user in await self.searchUsers(realmId, search=username):
+                if username == user['username']: return user
+            raise EpException(404, 'Not Found')
+        return await self.__cached__('user', f'{realmId}:name:{username}', reader)
+
+    async def searchUsers(self, realmId:str, search:str | None=None, first:int | None=None, max:int | None=None):
+        return await self.get(f'/admin/realms/{realmId}/users{self.__query__(search=search, first=first, max=max)}')
 
-    async def searchUsers(self, realmId:str, search:str | None=None):
-        if search: return await self.get(f'/admin/realms/{realmId}/users?search={search}')
-        else: return await self.get(f'/admin/realms/{realmId}/users')
+    async def countUsers(self, realmId:str, search:str | None=None):
+        return await self.get(f'/admin/realms/{realmId}/users/count{self.__query__(search=search)}')
 
-    async def searchUsersByGroupId(self, realmId:str, groupId:str):
-        return await self.get(f'/admin/realms/{realmId}/groups/{groupId}/members')
+    async def searchUsersByGroupId(self, realmId:str, groupId:str, first:int | None=None, max:int | None=None, brief:bool=False):
+        return await self.get(f"/admin/realms/{realmId}/groups/{groupId}/members{self.__query__(first=first, max=max, briefRepresentation='true' if brief else None)}")
 
     async def searchUsersByRoleId(self, realmId:str, roleId:str):
         return await self.searchUsersInRoleName(realmId, (await self.readRole(realmId, roleId))['name'])
@@ -504,12 +547,15 @@ class KeyCloak(DriverBase):
             'firstName': firstName,
             'lastName': lastName
         })
+        await self.__invalidate__('user')
 
     async def updateUser(self, realmId:str, user:dict):
         await self.put(f'/admin/realms/{realmId}/users/{user["id"]}', user)
+        await self.__invalidate__('user')
 
     async def setUserEnabled(self, realmId:str, userId:str, enabled:bool):
         await self.put(f'/admin/realms/{realmId}/users/{userId}', {'enabled': enabled})
+        await self.__invalidate__('user')
 
     async def setUserPassword(self, realmId:str, userId:str, password:str, temporary:bool=True):
         await self.put(f'/admin/realms/{realmId}/users/{userId}/reset-password', {
@@ -535,3 +581,4 @@ class KeyCloak(DriverBase):
 
     async def deleteUser(self, realmId:str, userId:str):
         await self.delete(f'/admin/realms/{realmId}/users/{userId}')
+        await self.__invalidate__('user')
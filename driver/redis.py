@@ -10,11 +10,24 @@ except: pass
 # Import
 #===============================================================================
 import json
+import zlib
+import asyncio
 import traceback
+from time import time as tstamp
 import redis.asyncio as redis
 from typing import Any
 from common import runBackground, DriverBase, KeyValueDriverBase, ModelDriverBase, SchemaInfo
 
+try: import zstandard
+except: zstandard = None
+
+#===============================================================================
+# Constants
+#===============================================================================
+_COMPRESS_HEADER_ZSTD = b'\x00Z'
+_COMPRESS_HEADER_ZLIB = b'\x00z'
+_NOT_FOUND_MARKER = b'\x00-'
+
 
 #===============================================================================
 # Implement
@@ -29,6 +42,8 @@ class RedisAccount(KeyValueDriverBase):
         self.raHostport = rdConf['hostport']
         self.raDatabase = int(raConf['database'])
         self.raExpire = int(raConf['expire'])
+        self.raChannel = f'{self.control.tenant}:authinfo'
+        self.raTokenChannel = f'{self.control.tenant}:systemtoken'
         self.raConn = None
 
     async def initialize(self, *args, **kargs): await self.connect()
@@ -51,20 +66,77 @@ class RedisAccount(KeyValueDriverBase):
             self.raConn = None
 
     async def setSystemToken(self, systemToken):
-        await self.raConn.set('systemToken', systemToken)
+        async with self.raConn.pipeline(transaction=True) as pipeline:
+            await pipeline.set('systemToken', systemToken).publish(self.raTokenChannel, systemToken).execute()
 
     async def getSystemToken(self):
         return await self.raConn.get('systemToken')
 
+    async def setRoleAcl(self, roleName, acl:dict):
+        await self.raConn.hset('roleAcl', roleName, json.dumps(acl, separators=(',', ':')))
+
+    async def delRoleAcl(self, roleName):
+        await self.raConn.hdel('roleAcl', roleName)
+
+    async def getRoleAcls(self, *roleNames):
+        if roleNames: return {roleName: json.loads(acl) for roleName, acl in zip(roleNames, await self.raConn.hmget('roleAcl', roleNames)) if acl is not None}
+        return {roleName: json.loads(acl) for roleName, acl in (await self.raConn.hgetall('roleAcl')).items()}
+
+    async def publishInvalidation(self, sessionId:str='*'):
+        await self.raConn.publish(self.raChannel, sessionId)
+
+    async def __listen__(self, channel:str):
+        async with self.raConn.pubsub() as pubsub:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message['type'] == 'message': yield message['data']
+
+    def listenInvalidation(self): return self.__listen__(self.raChannel)
+
+    def listenSystemToken(self): return self.__listen__(self.raTokenChannel)
+
     async def read(self, key:str, *args, **kargs):
         async with self.raConn.pipeline(transaction=True) as pipeline:
             result = (await pipeline.get(key).expire(key, self.raExpire).execute())[0]
         if result: result = json.loads(result)
         return result
 
-    async def write(self, key:str, val:Any, *args, **kargs):
+    async def getDirectory(self, kind:str, key:str):
+        data = await self.raConn.hget(f'dir:{kind}', key)
+        if data:
+            data = json.loads(data)
+            if data['expireAt'] > tstamp(): return data['data']
+        return None
+
+    async def setDirectory(self, kind:str, key:str, data:Any, expire:int):
         async with self.raConn.pipeline(transaction=True) as pipeline:
-            await pipeline.set(key, json.dumps(val, separators=(',', ':')), self.raExpire).execute()
+            await pipeline.hset(f'dir:{kind}', key, json.dumps({'expireAt': int(tstamp()) + expire, 'data': data}, separators=(',', ':'))).expire(f'dir:{kind}', expire, nx=True).execute()
+
+    async def delDirectory(self, *kinds):
+        await self.raConn.delete(*[f'dir:{kind}' for kind in kinds])
+
+    async def getCount(self, kind:str, search:str | None):
+        count = await self.raConn.hget(f'count:{kind}', search if search else '')
+        return int(count) if count is not None else None
+
+    async def setCount(self, kind:str, search:str | None, count:int, expire:int):
+        async with self.raConn.pipeline(transaction=True) as pipeline:
+            await pipeline.hset(f'count:{kind}', search if search else '', count).expire(f'count:{kind}', expire, nx=True).execute()
+
+    async def delCounts(self, kind:str):
+        await self.raConn.delete(f'count:{kind}')
+
+    async def readJob(self, jobId:str):
+        result = await self.raConn.get(f'job:{jobId}')
+        if result: result = json.loads(result)
+        return result
+
+    async def writeJob(self, jobId:str, job:dict, expire:int):
+        await self.write(f'job:{jobId}', job, expire)
+
+    async def write(self, key:str, val:Any, expire:int | None=None, *args, **kargs):
+        async with self.raConn.pipeline(transaction=True) as pipeline:
+            await pipeline.set(key, json.dumps(val, separators=(',', ':')), expire if expire else self.raExpire).execute()
 
     async def delete(self, key:str, *args, **kargs):
         await self.raConn.delete(key)
@@ -76,10 +148,18 @@ class RedisModel(ModelDriverBase):
         ModelDriverBase.__init__(self, control)
         rdConf = self.control.config['redis']
         rmConf = self.control.config['redis:model']
+        self.rmTenant = self.control.tenant
         self.rmHostname = rdConf['hostname']
         self.rmHostport = rdConf['hostport']
         self.rmDatabase = int(rmConf['database'])
         self.rmExpire = int(rmConf['expire'])
+        self.rmCompress = int(rmConf['compress']) if 'compress' in rmConf and rmConf['compress'] else 0
+        self.rmMaxKeys = int(rmConf['maxkeys']) if 'maxkeys' in rmConf and rmConf['maxkeys'] else 0
+        self.rmNegative = int(rmConf['negative']) if 'negative' in rmConf and rmConf['negative'] else 0
+        self.rmAdmit = int(rmConf['admit']) if 'admit' in rmConf and rmConf['admit'] else 1
+        self.rmBoost = int(rmConf['boost']) if 'boost' in rmConf and rmConf['boost'] else 1
+        self.rmWarmup = int(rmConf['warmup']) if 'warmup' in rmConf and rmConf['warmup'] else 0
+        self.rmStatSamples = int(rmConf['stat_samples']) if 'stat_samples' in rmConf and rmConf['stat_samples'] else 20
         self.rmConn = None
 
     async def initialize(self, *args, **kargs): await self.connect()
@@ -90,8 +170,7 @@ class RedisModel(ModelDriverBase):
             self.rmConn = await redis.Redis(
                 host=self.rmHostname,
                 port=self.rmHostport,
-                db=self.rmDatabase,
-                decode_responses=True
+                db=self.rmDatabase
             )
         return self
 
@@ -103,18 +182,107 @@ class RedisModel(ModelDriverBase):
 
     async def registerModel(self, schemaInfo:SchemaInfo, *args, **kargs):
         if 'expire' not in schemaInfo.cache or not schemaInfo.cache['expire']: schemaInfo.cache['expire'] = self.rmExpire
+        if 'compress' not in schemaInfo.cache or schemaInfo.cache['compress'] is None: schemaInfo.cache['compress'] = self.rmCompress
+        elif schemaInfo.cache['compress'] is True: schemaInfo.cache['compress'] = self.rmCompress if self.rmCompress else 1
+        else: schemaInfo.cache['compress'] = int(schemaInfo.cache['compress'])
+        if 'maxkeys' not in schemaInfo.cache or schemaInfo.cache['maxkeys'] is None: schemaInfo.cache['maxkeys'] = self.rmMaxKeys
+        if 'negative' not in schemaInfo.cache or schemaInfo.cache['negative'] is None: schemaInfo.cache['negative'] = self.rmNegative
+        if 'admit' not in schemaInfo.cache or not schemaInfo.cache['admit']: schemaInfo.cache['admit'] = self.rmAdmit
+        if 'boost' not in schemaInfo.cache or not schemaInfo.cache['boost']: schemaInfo.cache['boost'] = self.rmBoost
+        if 'warmup' not in schemaInfo.cache or schemaInfo.cache['warmup'] is None: schemaInfo.cache['warmup'] = self.rmWarmup
+        schemaInfo.cache['prefix'] = f'{self.rmTenant}:{schemaInfo.sref}:'
+        schemaInfo.cache['index'] = f'{self.rmTenant}:{schemaInfo.sref}'
+
+    def __encode_redis_data__(self, schemaInfo:SchemaInfo, model):
+        data = json.dumps(model, separators=(',', ':')).encode('utf-8')
+        compress = schemaInfo.cache['compress']
+        if compress and len(data) >= compress:
+            if zstandard: return _COMPRESS_HEADER_ZSTD + zstandard.compress(data)
+            return _COMPRESS_HEADER_ZLIB + zlib.compress(data)
+        return data
+
+    def __decode_redis_data__(self, data):
+        header = data[:2]
+        if header == _COMPRESS_HEADER_ZSTD: data = zstandard.decompress(data[2:])
+        elif header == _COMPRESS_HEADER_ZLIB: data = zlib.decompress(data[2:])
+        return json.loads(data)
+
+    def __get_redis_expire__(self, schemaInfo:SchemaInfo, frequency):
+        return schemaInfo.cache['expire'] * min(schemaInfo.cache['boost'], max(1, (frequency // schemaInfo.cache['admit']).bit_length()))
 
     async def read(self, schemaInfo:SchemaInfo, id:str):
+        prefix = schemaInfo.cache['prefix']
+        async with self.rmConn.pipeline(transaction=False) as pipeline:
+            (model, notFound), frequency, _ = await pipeline.mget(f'{prefix}{id}', f'{prefix}!{id}').incr(f'{prefix}#{id}').expire(f'{prefix}#{id}', schemaInfo.cache['expire']).execute()
+        if model:
+            if frequency > 1:
+                expire = self.__get_redis_expire__(schemaInfo, frequency)
+                if expire != self.__get_redis_expire__(schemaInfo, frequency - 1): await runBackground(self.__boost_redis_data__(schemaInfo, id, expire))
+            return self.__decode_redis_data__(model)
+        if notFound: return False
+        return None
+
+    async def __boost_redis_data__(self, schemaInfo:SchemaInfo, id:str, expire:int):
+        try:
+            async with self.rmConn.pipeline(transaction=True) as pipeline:
+                await pipeline.expire(f"{schemaInfo.cache['prefix']}{id}", expire).zadd(schemaInfo.cache['index'], {id: int(tstamp()) + expire}, xx=True).execute()
+        except Exception as e: LOG.DEBUG(e)
+
+    async def lockWarmup(self, schemaInfo:SchemaInfo, expire:int):
+        return True if await self.rmConn.set(f"{schemaInfo.cache['prefix']}@warmup", 'running', ex=expire, nx=True) else False
+
+    async def setWarmup(self, schemaInfo:SchemaInfo):
+        await self.rmConn.set(f"{schemaInfo.cache['prefix']}@warmup", 'ready', ex=schemaInfo.cache['expire'])
+
+    async def checkWarmup(self, schemaInfo:SchemaInfo):
+        return await self.rmConn.get(f"{schemaInfo.cache['prefix']}@warmup") == b'ready'
+
+    async def setNotFound(self, schemaInfo:SchemaInfo, id:str):
+        negative = schemaInfo.cache['negative']
+        if negative: await self.rmConn.set(f"{schemaInfo.cache['prefix']}!{id}", _NOT_FOUND_MARKER, negative)
+
+    async def clearNotFound(self, schemaInfo:SchemaInfo, *ids):
+        if ids and schemaInfo.cache['negative']:
+            prefix = schemaInfo.cache['prefix']
+            await self.rmConn.delete(*[f'{prefix}!{id}' for id in ids])
+
+    async def __set_redis_data__(self, schemaInfo:SchemaInfo, models, expires=None):
+        prefix = schemaInfo.cache['prefix']
+        index = schemaInfo.cache['index']
+        maxKeys = schemaInfo.cache['maxkeys']
+        if not expires: expires = [schemaInfo.cache['expire']] * len(models)
+        now = int(tstamp())
         async with self.rmConn.pipeline(transaction=True) as pipeline:
-            model = (await pipeline.get(id).expire(id, schemaInfo.cache['expire']).execute())[0]
-        if model: model = json.loads(model)
-        return model
-
-    async def __set_redis_data__(self, schemaInfo:SchemaInfo, models):
-        expire = schemaInfo.cache['expire']
-        async with self.rmConn.pipeline(transaction=True) as pipeline:
-            for model in models: pipeline.set(model['id'], json.dumps(model, separators=(',', ':')), expire)
-            await pipeline.execute()
+            for model, expire in zip(models, expires): pipeline.set(f"{prefix}{model['id']}", self.__encode_redis_data__(schemaInfo, model), expire)
+            pipeline.zadd(index, {model['id']: now + expire for model, expire in zip(models, expires)})
+            if schemaInfo.cache['negative']: pipeline.delete(*[f"{prefix}!{model['id']}" for model in models])
+            pipeline.zremrangebyscore(index, '-inf', now)
+            if maxKeys: pipeline.zcard(index)
+            results = await pipeline.execute()
+        if maxKeys and results[-1] > maxKeys: await self.__evict_redis_data__(schemaInfo, results[-1] - maxKeys)
+
+    async def __evict_redis_data__(self, schemaInfo:SchemaInfo, count):
+        prefix = schemaInfo.cache['prefix']
+        evicted = await self.rmConn.zpopmin(schemaInfo.cache['index'], count)
+        if evicted: await self.rmConn.unlink(*[f"{prefix}{id.decode('utf-8')}" for id, _ in evicted])
+
+    async def admit(self, schemaInfo:SchemaInfo, *models, counted:bool=False):
+        if models:
+            prefix = schemaInfo.cache['prefix']
+            expire = schemaInfo.cache['expire']
+            admit = schemaInfo.cache['admit']
+            if counted: frequencies = [int(frequency) if frequency else 0 for frequency in await self.rmConn.mget(*[f"{prefix}#{model['id']}" for model in models])]
+            else:
+                async with self.rmConn.pipeline(transaction=False) as pipeline:
+                    for model in models: pipeline.incr(f"{prefix}#{model['id']}").expire(f"{prefix}#{model['id']}", expire)
+                    frequencies = (await pipeline.execute())[0::2]
+            admitted = []
+            expires = []
+            for model, frequency in zip(models, frequencies):
+                if frequency >= admit:
+                    admitted.append(model)
+                    expires.append(self.__get_redis_expire__(schemaInfo, frequency))
+            if admitted: await self.__set_redis_data__(schemaInfo, admitted, expires)
 
     async def create(self, schemaInfo:SchemaInfo, *models):
         if models: await self.__set_redis_data__(schemaInfo, models)
@@ -123,7 +291,50 @@ class RedisModel(ModelDriverBase):
         if models: await self.__set_redis_data__(schemaInfo, models)
 
     async def delete(self, schemaInfo:SchemaInfo, id:str):
-        await self.rmConn.delete(id)
+        async with self.rmConn.pipeline(transaction=True) as pipeline:
+            await pipeline.delete(f"{schemaInfo.cache['prefix']}{id}").zrem(schemaInfo.cache['index'], id).execute()
+
+    async def flush(self, schemaInfo:SchemaInfo):
+        count = 0
+        keys = []
+        async for key in self.rmConn.scan_iter(match=f"{schemaInfo.cache['prefix']}*", count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                count += await self.rmConn.unlink(*keys)
+                keys = []
+        if keys: count += await self.rmConn.unlink(*keys)
+        await self.rmConn.delete(schemaInfo.cache['index'])
+        return count
+
+    async def stats(self, schemaInfo:SchemaInfo):
+        index = schemaInfo.cache['index']
+        prefix = schemaInfo.cache['prefix']
+        async with self.rmConn.pipeline(transaction=True) as pipeline:
+            _, keys, samples = await pipeline.zremrangebyscore(index, '-inf', int(tstamp())).zcard(index).zrandmember(index, self.rmStatSamples).execute()
+        memory = 0
+        if samples:
+            async with self.rmConn.pipeline(transaction=False) as pipeline:
+                for id in samples: pipeline.memory_usage(f"{prefix}{id.decode('utf-8')}")
+                usages = [usage for usage in await pipeline.execute(raise_on_error=False) if isinstance(usage, int)]
+            if usages: memory = int(sum(usages) / len(usages) * keys)
+        return {
+            'sref': schemaInfo.sref,
+            'keys': keys,
+            'memory': memory,
+            'expire': schemaInfo.cache['expire'],
+            'admit': schemaInfo.cache['admit'],
+            'boost': schemaInfo.cache['boost'],
+            'compress': schemaInfo.cache['compress'],
+            'maxkeys': schemaInfo.cache['maxkeys']
+        }
+
+
+def compareStreamId(id1:str, id2:str):
+    ms1, seq1 = id1.split('-') if '-' in id1 else (id1, 0)
+    ms2, seq2 = id2.split('-') if '-' in id2 else (id2, 0)
+    id1 = (int(ms1), int(seq1))
+    id2 = (int(ms2), int(seq2))
+    return (id1 > id2) - (id1 < id2)
 
 
 class RedisQueue(DriverBase):
@@ -133,12 +344,20 @@ class RedisQueue(DriverBase):
         rdConf = self.control.config['redis']
         rqConf = self.control.config['redis:queue']
         self.rqTenant = self.control.tenant
-        self.rqPattern = f'{self.rqTenant}:*:*'
         self.rqHostname = rdConf['hostname']
         self.rqHostport = rdConf['hostport']
         self.rqDatabase = int(rqConf['database'])
         self.rqExpire = int(rqConf['expire'])
+        self.rqStream = f'{self.rqTenant}:stream' if 'stream' in rqConf and rqConf['stream'].lower() in ('true', '1', 'yes') else None
+        self.rqStreamMaxLen = int(rqConf['stream_maxlen']) if 'stream_maxlen' in rqConf and rqConf['stream_maxlen'] else 10000
+        self.rqReplayLimit = int(rqConf['replay_limit']) if 'replay_limit' in rqConf and rqConf['replay_limit'] else 1000
         self.rqConn = None
+        self.rqPubSub = None
+        self.rqChannels = {}
+        self.rqPatterns = set()
+        self.rqSubscribed = set()
+        self.rqLock = asyncio.Lock()
+        self.rqReady = asyncio.Event()
 
     async def initialize(self, *args, **kargs): await self.connect()
 
@@ -154,29 +373,87 @@ class RedisQueue(DriverBase):
         return self
 
     async def disconnect(self):
+        if self.rqPubSub:
+            try: await self.rqPubSub.aclose()
+            except: pass
+            self.rqPubSub = None
+            self.rqSubscribed.clear()
+            self.rqPatterns.clear()
+            self.rqReady.clear()
         if self.rqConn:
             try: await self.rqConn.aclose()
             except: pass
             self.rqConn = None
 
-    async def subscribe(self, handler):
-        await runBackground(self.__subscribe__(handler))
-
-    async def __subscribe__(self, handler):
-        async with self.rqConn.pubsub() as pubsub:
-            await pubsub.psubscribe(self.rqPattern)
-            while True:
-                try: message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=10)
-                except Exception as e: LOG.DEBUG(e)
-                else:
-                    if message is not None:
-                        try:
-                            _, category, target = message['channel'].split(':')
-                            key, val = json.loads(message['data'])
-                            await handler(category, target, key, val)
-                        except Exception as e:
-                            LOG.ERROR(e)
-                            if LOG.isDebugMode(): LOG.DEBUG(traceback.extract_stack()[:-1])
+    async def listen(self, handler):
+        self.rqPubSub = self.rqConn.pubsub()
+        await runBackground(self.__listen__(handler))
+
+    def watch(self, category:str, target:str):
+        channel = f'{self.rqTenant}:{category}:{target}'
+        count = self.rqChannels.get(channel, 0) + 1
+        self.rqChannels[channel] = count
+        if count == 1: asyncio.create_task(self.__sync_channel__(channel))
+
+    def unwatch(self, category:str, target:str):
+        channel = f'{self.rqTenant}:{category}:{target}'
+        if channel not in self.rqChannels: return
+        if self.rqChannels[channel] > 1: self.rqChannels[channel] -= 1
+        else:
+            self.rqChannels.pop(channel)
+            asyncio.create_task(self.__sync_channel__(channel))
+
+    async def __sync_channel__(self, channel:str):
+        async with self.rqLock:
+            if not self.rqPubSub: return
+            wildcard = channel.endswith(':*')
+            try:
+                if channel in self.rqChannels and channel not in self.rqSubscribed:
+                    if wildcard: await self.rqPubSub.psubscribe(channel)
+                    else: await self.rqPubSub.subscribe(channel)
+                    self.rqSubscribed.add(channel)
+                    self.rqReady.set()
+                elif channel not in self.rqChannels and channel in self.rqSubscribed:
+                    if wildcard: await self.rqPubSub.punsubscribe(channel)
+                    else: await self.rqPubSub.unsubscribe(channel)
+                    self.rqSubscribed.discard(channel)
+            except Exception as e: LOG.ERROR(f'could not sync subscription of {channel}: {e}')
+
+    async def __listen__(self, handler):
+        await self.rqReady.wait()
+        while self.rqPubSub:
+            try: message = await self.rqPubSub.get_message(timeout=10)
+            except Exception as e:
+                LOG.DEBUG(e)
+                await asyncio.sleep(1)
+            else:
+                if message is not None:
+                    try:
+                        _, category, target = message['channel'].split(':', 2)
+                        if message['type'] == 'psubscribe': self.rqPatterns.add(category)
+                        elif message['type'] == 'punsubscribe': self.rqPatterns.discard(category)
+                        if message['type'] == 'pmessage' or (message['type'] == 'message' and category not in self.rqPatterns):
+                            await handler(category, target, *json.loads(message['data']), raw=message['data'])
+                    except Exception as e:
+                        LOG.ERROR(e)
+                        if LOG.isDebugMode(): LOG.DEBUG(traceback.extract_stack()[:-1])
 
     async def publish(self, category:str, target:str, key:str, val:Any):
-        await self.rqConn.publish(f'{self.rqTenant}:{category}:{target}', json.dumps([key, val], separators=(',', ':')))
+        if self.rqStream:
+            data = json.dumps([key, val], separators=(',', ':'))
+            id = await self.rqConn.xadd(self.rqStream, {'channel': f'{category}:{target}', 'data': data}, maxlen=self.rqStreamMaxLen, approximate=True)
+            await self.rqConn.publish(f'{self.rqTenant}:{category}:{target}', json.dumps([key, val, id], separators=(',', ':')))
+        else: await self.rqConn.publish(f'{self.rqTenant}:{category}:{target}', json.dumps([key, val], separators=(',', ':')))
+
+    async def replay(self, lastId:str):
+        if not self.rqStream: return None
+        oldest = await self.rqConn.xrange(self.rqStream, count=1)
+        if oldest and compareStreamId(oldest[0][0], lastId) > 0: return None
+        entries = await self.rqConn.xrange(self.rqStream, min=f'({lastId}', max='+', count=self.rqReplayLimit)
+        if len(entries) >= self.rqReplayLimit: return None
+        result = []
+        for id, fields in entries:
+            category, target = fields['channel'].split(':', 1)
+            key, val = json.loads(fields['data'])
+            result.append((category, target, key, val, id))
+        return result
@@ -29,6 +29,7 @@ def run():
     config.read(iniPath, encoding='utf-8')
     stage = config['default']['stage']
     modConf = config[module]
+    sockConf = config[f'{module}:socket']
 
     os.chdir(modPath)
     sys.path.append(prjPath)
@@ -41,5 +42,7 @@ def run():
         workers=int(modConf['workers']) if 'dev' not in stage else None,
         reload=True if 'dev' in stage else False,
         reload_dirs=[schPath, modPath] if 'dev' in stage else None,
-        log_level='debug' if 'dev' in stage else 'info'
+        log_level='debug' if 'dev' in stage else 'info',
+        ws_ping_interval=float(sockConf['ws_ping_interval']) if 'ws_ping_interval' in sockConf and sockConf['ws_ping_interval'] else 20.0,
+        ws_ping_timeout=float(sockConf['ws_ping_timeout']) if 'ws_ping_timeout' in sockConf and sockConf['ws_ping_timeout'] else 20.0
     )
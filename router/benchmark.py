@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+'''
+@copyright: Equal Plus
+@author: Hye-Churn Jang
+'''
+
+try: import LOG  # @UnresolvedImport
+except: pass
+#===============================================================================
+# Import
+#===============================================================================
+import os
+import sys
+import json
+import zlib
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+try: import msgpack
+except: msgpack = None
+try: import uvicorn
+except: uvicorn = None
+try: import websockets
+except: websockets = None
+try: import fakeredis
+except: fakeredis = None
+
+modPath = os.path.dirname(os.path.abspath(__file__))
+prjPath = os.path.dirname(modPath)
+
+
+#===============================================================================
+# Implement
+#===============================================================================
+def percentile(values, rate):
+    if not values: return None
+    return round(values[min(len(values) - 1, int(len(values) * rate))] * 1000, 3)
+
+
+class MemorySocket:
+
+    def __init__(self, client):
+        self.client = client
+        self.incoming = asyncio.Queue()
+
+    async def accept(self): pass
+
+    async def receive(self): return await self.incoming.get()
+
+    async def send_text(self, data): self.client.receive(data)
+
+    async def send_bytes(self, data): self.client.receive(data)
+
+    async def close(self): self.client.closed = True
+
+
+class Client:
+
+    def __init__(self, bench, token, targets):
+        self.bench = bench
+        self.token = token
+        self.targets = targets
+        self.connected = False
+        self.rejected = False
+        self.failed = False
+        self.closed = False
+        self.socket = None
+        self.reader = None
+
+    def encode(self, message):
+        if self.bench.encoding == 'msgpack': return msgpack.packb(message)
+        return json.dumps(message)
+
+    def receive(self, data):
+        now = time.time()
+        self.bench.received += len(data)
+        if isinstance(data, bytes):
+            if data[:1] == b'\x78': data = zlib.decompress(data)
+            frame = msgpack.unpackb(data) if self.bench.encoding == 'msgpack' else json.loads(data)
+        else: frame = json.loads(data)
+        for key, val, *_ in (frame[1] if frame[0] == 'batch' and isinstance(frame[1], list) else [frame]):
+            if key == 'mdstat' and isinstance(val, dict) and 'ts' in val:
+                self.bench.latencies.append(now - val['ts'])
+            elif key == 'ping': asyncio.create_task(self.send(['pong', val]))
+            elif key == 'status' and val == 'connected' and not self.connected:
+                self.connected = True
+                self.bench.connected += 1
+            elif key == 'status' and val in ('overloaded', 'too many connections'): self.rejected = True
+
+    async def send(self, message):
+        data = self.encode(message)
+        if isinstance(self.socket, MemorySocket): self.socket.incoming.put_nowait({'type': 'websocket.receive', 'bytes': data} if isinstance(data, bytes) else {'type': 'websocket.receive', 'text': data})
+        else: await self.socket.send(data)
+
+    async def connect(self):
+        try: await self.__connect__()
+        except Exception:
+            self.failed = True
+            raise
+
+    async def __connect__(self):
+        auth = self.encode(['auth', self.token, None, {'encoding': self.bench.encoding, 'deflate': self.bench.deflate}])
+        if self.bench.url:
+            self.socket = await websockets.connect(self.bench.url, max_size=None, compression=None)
+            await self.socket.send(auth)
+            self.reader = asyncio.create_task(self.__read__())
+        else:
+            self.socket = MemorySocket(self)
+            self.socket.incoming.put_nowait({'type': 'websocket.receive', 'bytes': auth} if isinstance(auth, bytes) else {'type': 'websocket.receive', 'text': auth})
+            self.reader = asyncio.create_task(self.bench.ctrl.listenSocket(self.socket))
+
+    async def __read__(self):
+        try:
+            async for data in self.socket: self.receive(data)
+        except: pass
+        self.closed = True
+
+    async def close(self):
+        if isinstance(self.socket, MemorySocket): self.socket.incoming.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        elif self.socket:
+            try: await self.socket.close()
+            except: pass
+        try: await asyncio.wait_for(self.reader, 5)
+        except: pass
+
+
+class Benchmark:
+
+    def __init__(self, args):
+        self.args = args
+        self.encoding = 'msgpack' if args.msgpack else 'json'
+        self.deflate = args.deflate
+        self.url = None
+        self.ctrl = None
+        self.server = None
+        self.clients = []
+        self.connected = 0
+        self.received = 0
+        self.latencies = []
+
+    async def checkBearerToken(self, token):
+        from common import AuthInfo
+        username, group = token.split('/')
+        return AuthInfo(id=username, username=username, email=f'{username}@benchmark', admin=False, groups=[group])
+
+    async def setup(self):
+        sys.path.append(prjPath)
+        from service.controls import Control
+        self.ctrl = Control(f'{modPath}/service/controls.py')
+        if self.args.redis: await self.ctrl.queue.connect()
+        elif fakeredis: self.ctrl.queue.rqConn = fakeredis.FakeAsyncRedis(decode_responses=True)
+        else: raise Exception('fakeredis is required without --redis')
+        if self.args.url:
+            if not websockets: raise Exception('websockets is required with --url')
+            self.url = self.args.url
+            return
+        self.ctrl.checkBearerToken = self.checkBearerToken
+        await self.ctrl.queue.listen(self.ctrl.listenQueue)
+        if self.args.tcp:
+            if not uvicorn or not websockets: raise Exception('uvicorn and websockets are required with --tcp')
+            from fastapi import FastAPI
+            app = FastAPI()
+            app.add_api_websocket_route(f'{self.ctrl.uriver}/websocket', self.ctrl.listenSocket)
+            self.server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=self.args.port, log_level='warning', ws_per_message_deflate=False))
+            asyncio.create_task(self.server.serve())
+            while not self.server.started: await asyncio.sleep(0.1)
+            self.url = f'ws://127.0.0.1:{self.args.port}{self.ctrl.uriver}/websocket'
+
+    async def connect(self):
+        args = self.args
+        for index in range(args.connections):
+            if args.url: self.clients.append(Client(self, args.token, [('user', args.username)]))
+            else:
+                username = f'bench{index % args.users}'
+                group = f'bench{index % args.users % args.groups}'
+                self.clients.append(Client(self, f'{username}/{group}', [('user', username), ('group', group)]))
+        for index in range(0, len(self.clients), args.concurrency):
+            await asyncio.gather(*[client.connect() for client in self.clients[index:index + args.concurrency]], return_exceptions=True)
+        await self.wait(lambda: all(client.connected or client.rejected or client.failed or client.closed for client in self.clients), args.timeout)
+        await asyncio.sleep(0.5)
+
+    async def publish(self):
+        args = self.args
+        members = {}
+        for client in self.clients:
+            if client.connected and not client.closed:
+                for target in client.targets: members[target] = members.get(target, 0) + 1
+        targets = [target for target in members if target[0] == args.fanout] or [target for target in members if target[0] == 'user']
+        if not targets: return 0, 0
+        expected = 0
+        start = time.time()
+        for index in range(args.events):
+            category, target = targets[index % len(targets)]
+            expected += members[(category, target)]
+            await self.ctrl.queue.publish(category, target, 'mdstat', {'sref': 'benchmark.mdstat', 'id': str(index), 'ts': time.time(), 'data': 'x' * args.payload})
+            if args.rate:
+                delay = start + (index + 1) / args.rate - time.time()
+                if delay > 0: await asyncio.sleep(delay)
+        return expected, time.time() - start
+
+    async def wait(self, condition, timeout):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline: await asyncio.sleep(0.05)
+
+    async def teardown(self):
+        await asyncio.gather(*[client.close() for client in self.clients], return_exceptions=True)
+        if self.server: self.server.should_exit = True
+        await self.ctrl.queue.disconnect()
+
+    async def run(self):
+        await self.setup()
+        inProcess = not self.args.url
+        if inProcess:
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.time()
+        await self.connect()
+        connectTime = time.time() - start
+        memory = (tracemalloc.get_traced_memory()[0] - baseline) / max(self.connected, 1) if inProcess else None
+        if inProcess: tracemalloc.stop()
+        expected, publishTime = await self.publish()
+        await self.wait(lambda: len(self.latencies) >= expected, self.args.timeout)
+        latencies = sorted(self.latencies)
+        report = {
+            'connections': len(self.clients),
+            'connected': self.connected,
+            'rejected': sum(1 for client in self.clients if client.rejected),
+            'failed': sum(1 for client in self.clients if client.failed or not (client.connected or client.rejected)),
+            'connectSeconds': round(connectTime, 3),
+            'memoryPerConnection': round(memory) if memory is not None else None,
+            'events': self.args.events,
+            'publishSeconds': round(publishTime, 3),
+            'expected': expected,
+            'delivered': len(latencies),
+            'dropRate': round(1 - len(latencies) / expected, 6) if expected else 0,
+            'receivedBytes': self.received,
+            'latencyMs': {
+                'p50': percentile(latencies, 0.5),
+                'p90': percentile(latencies, 0.9),
+                'p99': percentile(latencies, 0.99),
+                'p999': percentile(latencies, 0.999),
+                'max': percentile(latencies, 1)
+            }
+        }
+        if inProcess: report['router'] = await self.ctrl.getSocketStats()
+        await self.teardown()
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='router websocket load test')
+    parser.add_argument('-c', '--connections', type=int, default=1000, help='number of sockets')
+    parser.add_argument('-u', '--users', type=int, default=100, help='number of distinct users')
+    parser.add_argument('-g', '--groups', type=int, default=10, help='number of distinct groups')
+    parser.add_argument('-e', '--events', type=int, default=1000, help='number of mdstat events to publish')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='events per second (0 publishes as fast as possible)')
+    parser.add_argument('-f', '--fanout', choices=['group', 'user'], default='group', help='channel category to publish to')
+    parser.add_argument('-p', '--payload', type=int, default=64, help='extra payload bytes per event')
+    parser.add_argument('--concurrency', type=int, default=200, help='sockets opened at once')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for connections and deliveries')
+    parser.add_argument('--msgpack', action='store_true', help='negotiate msgpack frames')
+    parser.add_argument('--deflate', action='store_true', help='negotiate deflate frames')
+    parser.add_argument('--redis', action='store_true', help='publish through the redis of project.ini instead of an in-memory stand-in')
+    parser.add_argument('--tcp', action='store_true', help='serve the router on a local port and connect with real websockets')
+    parser.add_argument('--port', type=int, default=18080, help='local port for --tcp')
+    parser.add_argument('--url', help='websocket url of a running router (requires --redis, --token and --username)')
+    parser.add_argument('--token', help='bearer token used by every socket with --url')
+    parser.add_argument('--username', help='username of --token, events are published to this user with --url')
+    args = parser.parse_args()
+
+    if args.url and not (args.redis and args.token and args.username): parser.error('--url requires --redis, --token and --username')
+    if args.msgpack and not msgpack: parser.error('msgpack is not installed')
+    if args.url: args.fanout = 'user'
+    try: import uvloop; uvloop.install()
+    except: pass
+    print(json.dumps(asyncio.run(Benchmark(args).run()), indent=2))
@@ -9,15 +9,198 @@ except: pass
 #===============================================================================
 # Import
 #===============================================================================
+import json
+import zlib
+import asyncio
 import traceback
+from collections import deque
 from fastapi import WebSocketDisconnect
-from common import SessionControl
-from driver.redis import RedisAccount, RedisQueue
+from common import SessionControl, asleep, runBackground, getTStamp
+from driver.redis import RedisAccount, RedisQueue, compareStreamId
+
+try: import msgpack
+except: msgpack = None
 
 
 #===============================================================================
 # Implement
 #===============================================================================
+class Connection:
+
+    def __init__(self, control, socket, authInfo, encoding='json', deflate=False):
+        self.control = control
+        self.socket = socket
+        self.authInfo = authInfo
+        self.encoding = encoding
+        self.deflate = deflate
+        self.queue = deque()
+        self.event = asyncio.Event()
+        self.flush = asyncio.Event()
+        self.ping = None
+        self.closed = False
+        self.sent = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.lastId = None
+        self.pending = None
+        self.filters = None
+        self.batchWindow = control.socketBatchWindow
+        self.lastSeen = getTStamp()
+        self.writer = asyncio.create_task(self.__write__())
+
+    def __ident__(self, key, val):
+        return (key, val['id']) if isinstance(val, dict) and 'id' in val else None
+
+    def __filters__(self, val):
+        if val is None: return []
+        if not isinstance(val, list): val = [val]
+        filters = []
+        for item in val:
+            if isinstance(item, str) and item: filters.append((item, None))
+            elif isinstance(item, dict) and 'sref' in item and isinstance(item['sref'], str) and item['sref'] and ('id' not in item or item['id'] is None or isinstance(item['id'], (str, int))):
+                filters.append((item['sref'], item['id'] if 'id' in item and item['id'] else None))
+            else: raise ValueError(f'invalid filter {item}')
+        return filters
+
+    def subscribe(self, val):
+        try: filters = self.__filters__(val)
+        except ValueError: return self.push('status', 'invalid filter')
+        if filters and self.filters is None: self.filters = {}
+        for sref, id in filters:
+            if id is None: self.filters[sref] = None
+            elif sref not in self.filters: self.filters[sref] = {id}
+            elif self.filters[sref] is not None: self.filters[sref].add(id)
+        self.push('subscribe', self.getFilters())
+
+    def unsubscribe(self, val):
+        try: filters = self.__filters__(val)
+        except ValueError: return self.push('status', 'invalid filter')
+        if self.filters is not None:
+            if not filters: self.filters = None
+            for sref, id in filters:
+                if sref not in self.filters: continue
+                if id is None or self.filters[sref] is None: self.filters.pop(sref)
+                else:
+                    self.filters[sref].discard(id)
+                    if not self.filters[sref]: self.filters.pop(sref)
+            if not self.filters: self.filters = None
+        self.push('subscribe', self.getFilters())
+
+    def batch(self, val):
+        try: self.batchWindow = max(0, min(int(val), self.control.socketBatchWindowMax))
+        except: pass
+        self.push('batch', self.batchWindow)
+
+    def getFilters(self):
+        if self.filters is None: return None
+        return [{'sref': sref} if ids is None else {'sref': sref, 'ids': list(ids)} for sref, ids in self.filters.items()]
+
+    def match(self, val):
+        if self.filters is None or not isinstance(val, dict) or 'sref' not in val: return True
+        sref = val['sref']
+        if sref not in self.filters: return False
+        ids = self.filters[sref]
+        return ids is None or ('id' in val and val['id'] in ids)
+
+    def push(self, key, val, id=None, cache=None):
+        if self.closed or not self.match(val): return
+        if id:
+            if self.pending is not None: return self.pending.append((key, val, id, cache))
+            if self.lastId and compareStreamId(id, self.lastId) <= 0: return
+            self.lastId = id
+        if len(self.queue) >= self.control.socketQueueSize + (self.control.socketBatchSize if self.batchWindow else 0):
+            if self.control.socketOverflow == 'disconnect':
+                self.control.socketDisconnected += 1
+                LOG.DEBUG(f'disconnect slow socket of {self.authInfo.username}')
+                return self.close()
+            index = None
+            if self.control.socketOverflow == 'coalesce':
+                ident = self.__ident__(key, val)
+                if ident:
+                    for qIndex, (qKey, qVal, _, _) in enumerate(self.queue):
+                        if self.__ident__(qKey, qVal) == ident:
+                            index = qIndex
+                            break
+            if index is None: self.queue.popleft()
+            else: del self.queue[index]
+            self.dropped += 1
+            self.control.socketDropped += 1
+        self.queue.append((key, val, id, cache))
+        self.event.set()
+        if self.batchWindow and len(self.queue) >= self.control.socketBatchSize: self.flush.set()
+
+    def heartbeat(self, now):
+        if self.closed: return
+        self.ping = now
+        self.event.set()
+
+    def resume(self, entries):
+        pending = self.pending
+        self.pending = None
+        if entries is None: self.push('status', 'resync')
+        else:
+            for key, val, id in entries: self.push(key, val, id)
+        for key, val, id, cache in pending: self.push(key, val, id, cache)
+
+    async def __write__(self):
+        try:
+            while True:
+                while not self.queue and self.ping is None:
+                    self.event.clear()
+                    await self.event.wait()
+                if self.ping is not None:
+                    ping, self.ping = self.ping, None
+                    await asyncio.wait_for(self.socket.send_text(self.control.encodeFrame(['ping', ping], 'json')), self.control.socketSendTimeout)
+                    continue
+                if self.batchWindow:
+                    if len(self.queue) < self.control.socketBatchSize:
+                        self.flush.clear()
+                        try: await asyncio.wait_for(self.flush.wait(), self.batchWindow / 1000)
+                        except asyncio.TimeoutError: pass
+                    frames = {}
+                    while self.queue and len(frames) < self.control.socketBatchSize:
+                        key, val, id, _ = self.queue.popleft()
+                        ident = self.__ident__(key, val) or object()
+                        frames.pop(ident, None)
+                        frames[ident] = [key, val, id] if id else [key, val]
+                    if not frames: continue
+                    await self.send(['batch', list(frames.values())])
+                else:
+                    key, val, id, cache = self.queue.popleft()
+                    await self.send([key, val, id] if id else [key, val], cache)
+                self.sent += 1
+        except asyncio.CancelledError: pass
+        except Exception as e: LOG.DEBUG(f'socket writer of {self.authInfo.username} is stopped: {e}')
+        self.close()
+
+    async def send(self, frame, cache=None):
+        if cache is None: cache = {}
+        codec = self.encoding
+        if codec in cache: data = cache[codec]
+        else: data = cache[codec] = self.control.encodeFrame(frame, codec)
+        if self.deflate and len(data) >= self.control.socketDeflateThreshold:
+            codec = f'{codec}:deflate'
+            if codec in cache: data = cache[codec]
+            else: data = cache[codec] = self.control.deflateFrame(data)
+        await asyncio.wait_for(self.socket.send_text(data) if isinstance(data, str) else self.socket.send_bytes(data), self.control.socketSendTimeout)
+        self.bytes += len(data)
+
+    async def receive(self):
+        return await self.control.receiveFrame(self.socket, self.encoding)
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.queue.clear()
+        self.control.unregister(self)
+        if self.writer is not asyncio.current_task(): self.writer.cancel()
+        asyncio.create_task(self.__close__())
+
+    async def __close__(self):
+        try: await self.socket.close()
+        except: pass
+
+
 class Control(SessionControl):
 
     def __init__(self, path):
@@ -25,80 +208,202 @@ class Control(SessionControl):
         self.queue = RedisQueue(self)
         self.userSockets = {}
         self.groupSockets = {}
+        self.socketKeys = {}
+        self.socketPeak = 0
+
+        socketConf = self.config[f'{self.module}:socket']
+        self.socketQueueSize = int(socketConf['queue_size']) if 'queue_size' in socketConf and socketConf['queue_size'] else 256
+        self.socketOverflow = socketConf['overflow'] if 'overflow' in socketConf and socketConf['overflow'] in ('drop', 'coalesce', 'disconnect') else 'drop'
+        self.socketSendTimeout = int(socketConf['send_timeout']) if 'send_timeout' in socketConf and socketConf['send_timeout'] else 10
+        self.socketBatchWindow = int(socketConf['batch_window']) if 'batch_window' in socketConf and socketConf['batch_window'] else 0
+        self.socketBatchWindowMax = int(socketConf['batch_window_max']) if 'batch_window_max' in socketConf and socketConf['batch_window_max'] else 1000
+        self.socketBatchSize = int(socketConf['batch_size']) if 'batch_size' in socketConf and socketConf['batch_size'] else 500
+        self.socketDeflateThreshold = int(socketConf['deflate_threshold']) if 'deflate_threshold' in socketConf and socketConf['deflate_threshold'] else 0
+        self.socketDeflateLevel = int(socketConf['deflate_level']) if 'deflate_level' in socketConf and socketConf['deflate_level'] else 6
+        self.socketAuthTimeout = int(socketConf['auth_timeout']) if 'auth_timeout' in socketConf and socketConf['auth_timeout'] else 10
+        self.socketHeartbeatInterval = int(socketConf['heartbeat_interval']) if 'heartbeat_interval' in socketConf and socketConf['heartbeat_interval'] else 0
+        self.socketHeartbeatTimeout = int(socketConf['heartbeat_timeout']) if 'heartbeat_timeout' in socketConf and socketConf['heartbeat_timeout'] else 0
+        self.socketMaxUserConnections = int(socketConf['max_user_connections']) if 'max_user_connections' in socketConf and socketConf['max_user_connections'] else 0
+        self.socketMaxConnections = int(socketConf['max_connections']) if 'max_connections' in socketConf and socketConf['max_connections'] else 0
+        self.socketDropped = 0
+        self.socketDisconnected = 0
+        self.socketReaped = 0
+        self.socketRejected = 0
+        self.socketAuthenticating = 0
 
     async def startup(self):
         await self.queue.connect()
-        await self.queue.subscribe(self.listenQueue)
+        await self.queue.listen(self.listenQueue)
+        if self.socketHeartbeatInterval and self.socketHeartbeatTimeout: await runBackground(self.__heartbeat__())
+        self.api.add_api_route(
+            methods=['GET'],
+            path='/internal/socket',
+            endpoint=self.getSocketStats, response_model=dict, tags=['Internal'], name='Socket Stats'
+        )
 
     async def shutdown(self):
+        for connection in list(self.socketKeys): connection.close()
         await self.queue.disconnect()
 
-    async def listenQueue(self, category, target, key, val):
+    def register(self, connection):
+        authInfo = connection.authInfo
+        keys = [('user', authInfo.username)] + [('group', group) for group in (['admin'] if authInfo.admin else set(authInfo.groups))]
+        for category, key in keys:
+            registry = self.userSockets if category == 'user' else self.groupSockets
+            if key not in registry:
+                registry[key] = set()
+                self.queue.watch(category, '*' if category == 'group' and key == 'admin' else key)
+            registry[key].add(connection)
+        self.socketKeys[connection] = keys
+        self.socketPeak = max(self.socketPeak, len(self.socketKeys))
+
+    def unregister(self, connection):
+        for category, key in self.socketKeys.pop(connection, []):
+            registry = self.userSockets if category == 'user' else self.groupSockets
+            connections = registry.get(key)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    registry.pop(key)
+                    self.queue.unwatch(category, '*' if category == 'group' and key == 'admin' else key)
+
+    async def __heartbeat__(self):
+        while True:
+            await asleep(self.socketHeartbeatInterval)
+            now = getTStamp()
+            for connection in list(self.socketKeys):
+                if now - connection.lastSeen > self.socketHeartbeatTimeout:
+                    self.socketReaped += 1
+                    LOG.DEBUG(f'reap silent socket of {connection.authInfo.username}')
+                    connection.close()
+                else: connection.heartbeat(now)
+
+    async def rejectSocket(self, socket, code, reason):
+        self.socketRejected += 1
+        try:
+            await socket.send_text(self.encodeFrame(['status', reason], 'json'))
+            await socket.close(code)
+        except: pass
+
+    async def getSocketStats(self, detail:bool=False) -> dict:
+        connections = self.socketKeys.keys()
+        stats = {
+            'connections': len(connections),
+            'authenticating': self.socketAuthenticating,
+            'peak': self.socketPeak,
+            'users': len(self.userSockets),
+            'groups': len(self.groupSockets),
+            'channels': len(self.queue.rqSubscribed),
+            'queued': sum(len(connection.queue) for connection in connections),
+            'maxQueued': max((len(connection.queue) for connection in connections), default=0),
+            'sent': sum(connection.sent for connection in connections),
+            'bytes': sum(connection.bytes for connection in connections),
+            'msgpack': sum(1 for connection in connections if connection.encoding == 'msgpack'),
+            'deflate': sum(1 for connection in connections if connection.deflate),
+            'dropped': self.socketDropped,
+            'disconnected': self.socketDisconnected,
+            'reaped': self.socketReaped,
+            'rejected': self.socketRejected,
+            'queueSize': self.socketQueueSize,
+            'overflow': self.socketOverflow,
+            'maxUserConnections': self.socketMaxUserConnections,
+            'maxConnections': self.socketMaxConnections
+        }
+        if detail:
+            stats['sockets'] = [{
+                'username': connection.authInfo.username,
+                'encoding': connection.encoding,
+                'deflate': connection.deflate,
+                'batchWindow': connection.batchWindow,
+                'sent': connection.sent,
+                'bytes': connection.bytes,
+                'dropped': connection.dropped,
+                'queued': len(connection.queue),
+                'lastSeen': connection.lastSeen
+            } for connection in connections]
+        return stats
+
+    def encodeFrame(self, frame, encoding):
+        if encoding == 'msgpack': return msgpack.packb(frame)
+        return json.dumps(frame, separators=(',', ':'))
+
+    def deflateFrame(self, data):
+        return zlib.compress(data if isinstance(data, bytes) else data.encode(), self.socketDeflateLevel)
+
+    async def receiveFrame(self, socket, encoding='json'):
+        message = await socket.receive()
+        if message['type'] == 'websocket.disconnect': raise WebSocketDisconnect(message.get('code', 1000))
+        if 'text' in message and message['text'] is not None: return json.loads(message['text'])
+        data = message['bytes']
+        if data[:1] == b'\x78': data = zlib.decompress(data)
+        if encoding == 'msgpack' and msgpack: return msgpack.unpackb(data)
+        return json.loads(data)
+
+    async def listenQueue(self, category, target, key, val, id=None, raw=None):
+        cache = {'json': raw} if raw else {}
         if category == 'group':
             if 'admin' in self.groupSockets:
-                for socket in self.groupSockets['admin']:
-                    try: await socket.send_json([key, val])
-                    except: pass
+                for connection in tuple(self.groupSockets['admin']): connection.push(key, val, id, cache)
             if target in self.groupSockets:
-                for socket in self.groupSockets[target]:
-                    try: await socket.send_json([key, val])
-                    except: pass
+                for connection in tuple(self.groupSockets[target]): connection.push(key, val, id, cache)
             LOG.DEBUG(f'send to {self.tenant}:group:{target}')
         elif category == 'user':
             if target in self.userSockets:
-                for socket in self.userSockets[target]:
-                    try: await socket.send_json([key, val])
-                    except: pass
+                for connection in tuple(self.userSockets[target]): connection.push(key, val, id, cache)
                 LOG.DEBUG(f'send to {self.tenant}:user:{target}')
 
+    async def replayQueue(self, connection, lastId):
+        try: entries = await self.queue.replay(lastId)
+        except Exception as e:
+            LOG.DEBUG(f'could not replay from {lastId}: {e}')
+            entries = None
+        if entries is not None:
+            authInfo = connection.authInfo
+            groups = set(authInfo.groups)
+            entries = [(key, val, id) for category, target, key, val, id in entries if (category == 'user' and target == authInfo.username) or (category == 'group' and (authInfo.admin or target in groups))]
+        connection.resume(entries)
+
     async def listenSocket(self, socket):
         await socket.accept()
-        try: key, token = await socket.receive_json()
-        except: await socket.close()
-        else:
-            if key == 'auth':
+        if self.socketMaxConnections and len(self.socketKeys) + self.socketAuthenticating >= self.socketMaxConnections: return await self.rejectSocket(socket, 1013, 'overloaded')
+        self.socketAuthenticating += 1
+        try:
+            message = await asyncio.wait_for(self.receiveFrame(socket, 'msgpack'), self.socketAuthTimeout)
+            key, token = message[0], message[1]
+            lastId = message[2] if len(message) > 2 and message[2] else None
+            options = message[3] if len(message) > 3 and isinstance(message[3], dict) else {}
+            if key != 'auth': raise Exception('first message is not auth')
+            authInfo = await self.checkBearerToken(token)
+        except:
+            try: await socket.close()
+            except: pass
+            return
+        finally: self.socketAuthenticating -= 1
+        if self.socketMaxUserConnections and len(self.userSockets.get(authInfo.username, ())) >= self.socketMaxUserConnections: return await self.rejectSocket(socket, 1008, 'too many connections')
+        encoding = 'msgpack' if msgpack and 'encoding' in options and options['encoding'] == 'msgpack' else 'json'
+        deflate = True if 'deflate' in options and options['deflate'] and self.socketDeflateThreshold else False
+        connection = Connection(self, socket, authInfo, encoding, deflate)
+        if lastId and self.queue.rqStream: connection.pending = []
+        self.register(connection)
+        connection.push('status', 'connected')
+        if connection.pending is not None: await self.replayQueue(connection, lastId)
+        try:
+            while not connection.closed:
                 try:
-                    authInfo = await self.checkBearerToken(token)
-                    username = authInfo.username
-                    if username not in self.userSockets: self.userSockets[username] = []
-                    self.userSockets[username].append(socket)
-                    if authInfo.checkAdmin():
-                        if 'admin' not in self.groupSockets: self.groupSockets['admin'] = []
-                        self.groupSockets['admin'].append(socket)
-                    else:
-                        for group in authInfo.groups:
-                            if group not in self.groupSockets: self.groupSockets[group] = []
-                            self.groupSockets[group].append(socket)
-                    await socket.send_json(['status', 'connected'])
-                except:
-                    try: self.userSockets.remove(socket)
-                    except: pass
-                    if authInfo.checkAdmin():
-                        try: self.groupSockets['admin'].remove(socket)
-                        except: pass
-                    else:
-                        for group in authInfo.groups:
-                            try: self.groupSockets[group].remove(socket)
-                            except: pass
-                    try: await socket.close()
-                    except: pass
-                else:
-                    while True:
-                        try:
-                            key, val = await socket.receive_json()
-                            await self.socketHandler(socket, authInfo, key, val)
-                        except WebSocketDisconnect:
-                            try: self.userSockets.remove(socket)
-                            except: pass
-                            for group in authInfo.groups:
-                                try: self.groupSockets[group].remove(socket)
-                                except: pass
-                            break
-                        except Exception as e:
-                            if LOG.isDebugMode():
-                                LOG.DEBUG(e)
-                                LOG.DEBUG(traceback.extract_stack()[:-1])
-            else: await socket.close()
-
-    async def socketHandler(self, socket, authInfo, key, val):
-        socket.send_json([key, val])
+                    key, val = await connection.receive()
+                    connection.lastSeen = getTStamp()
+                    await self.socketHandler(connection, key, val)
+                except (WebSocketDisconnect, RuntimeError): break
+                except Exception as e:
+                    if LOG.isDebugMode():
+                        LOG.DEBUG(e)
+                        LOG.DEBUG(traceback.extract_stack()[:-1])
+        finally: connection.close()
+
+    async def socketHandler(self, connection, key, val):
+        if key == 'subscribe': connection.subscribe(val)
+        elif key == 'unsubscribe': connection.unsubscribe(val)
+        elif key == 'batch': connection.batch(val)
+        elif key == 'ping': connection.push('pong', val)
+        elif key == 'pong': pass
+        else: connection.push(key, val)
@@ -19,7 +19,7 @@ from common import SECONDS, AAA, SchemaConfig, Option, Key, BaseSchema, ProfSche
 @SchemaConfig(
 version=1,
 aaa=AAA.AAA,
-cache=Option(expire=SECONDS.HOUR),
+cache=Option(expire=SECONDS.HOUR, compress=1024),
 search=Option(expire=SECONDS.DAY))
 class OpenSsh(BaseModel, ProfSchema, BaseSchema):
     rsaBits: int = 4096
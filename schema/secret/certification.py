@@ -19,7 +19,7 @@ from common import SECONDS, AAA, SchemaConfig, Option, Reference, Key, BaseSchem
 @SchemaConfig(
 version=1,
 aaa=AAA.AAG,
-cache=Option(expire=SECONDS.HOUR),
+cache=Option(expire=SECONDS.HOUR, compress=1024),
 search=Option(expire=SECONDS.DAY))
 class Authority(BaseModel, ProfSchema, BaseSchema):
 
@@ -42,7 +42,7 @@ class Authority(BaseModel, ProfSchema, BaseSchema):
 @SchemaConfig(
 version=1,
 aaa=AAA.AAG,
-cache=Option(expire=SECONDS.HOUR),
+cache=Option(expire=SECONDS.HOUR, compress=1024),
 search=Option(expire=SECONDS.DAY))
 class Server(BaseModel, ProfSchema, BaseSchema):
     ca: Reference
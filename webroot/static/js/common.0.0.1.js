@@ -262,7 +262,10 @@ window.Common = window.Common || {
 				let socket = new WebSocket(`wss://${Config.endpoint}${url}`);
 				socket.sendJson = async (data) => { return socket.send(JSON.stringify(data)); };
 				socket.sendData = async (key, value) => { return socket.send(JSON.stringify([key, value])); };
-				socket.onmessage = (event) => { receiver(event.target, event.data); };
+				socket.onmessage = (event) => {
+					if (typeof event.data == "string" && event.data.startsWith('["ping"')) { return event.target.sendData("pong", JSON.parse(event.data)[1]); }
+					receiver(event.target, event.data);
+				};
 				socket.onerror = (event) => { console.error("(wsock) error", event); };
 				socket.onopen = (event) => {
 					console.log("(wsock) open");
@@ -497,11 +500,7 @@ window.Common = window.Common || {
 				return Common.Util.setArrayFunctions(result);
 			};
 			this.updateUsers = async (userObjs) => {
-				let result = [];
-				(await Common.Rest.put(`${Common.Account.url}/group/${this.id}/user`, userObjs)).forEach((resource) => {
-					result.push(new User(resource));
-				});
-				return Common.Util.setArrayFunctions(result);
+				return Common.Util.setArrayFunctions(await Common.Rest.put(`${Common.Account.url}/group/${this.id}/user`, userObjs));
 			};
 			this.reload = async () => { return Object.assign(this, await Common.Rest.get(`${Common.Account.url}/group/${this.id}`)); };
 			this.update = async () => { return Object.assign(this, await Common.Rest.post(`${Common.Account.url}/group/${this.id}`, this)); };